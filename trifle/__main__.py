@@ -4,8 +4,9 @@ import logging
 import gettext
 import os
 import signal
+import sys
 
-from trifle.utils import CACHE_PATH, MODULE_PATH, logger
+from trifle.utils import CACHE_PATH, MODULE_PATH, logger, sqlite
 
 # Create a cache dir if it doesn't exist yet
 # Adding this to __init__ will fail us with creating directory belonging to
@@ -42,6 +43,16 @@ logger.setLevel(logging.DEBUG if arguments.debug else logging.WARNING)
 # https://bugzilla.gnome.org/show_bug.cgi?id=622084
 # NOTE: Will not execute a cleanup function in application
 signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+# Dump SQLite statistics on demand with `kill -USR1`. Handlers installed
+# with signal module don't run while Gtk main loop waits for events.
+def print_statistics():
+    print(sqlite.statistics.report(), file=sys.stderr)
+    return True
+
+
+GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, print_statistics)
 # Threading support
 GLib.threads_init()
 # Should go latest. Do NOT move this import to the begining
@@ -8,5 +8,7 @@ parser.add_argument('-v', '--verbose', action='store_true',
                     help=_('More verbose messages'))
 parser.add_argument('--devtools', action='store_true',
                     help=_('Display WebKit developers tool upon start'))
+parser.add_argument('--sql-stats', action='store_true',
+                    help=_('Print SQLite statement statistics on exit'))
 
 arguments = parser.parse_args()
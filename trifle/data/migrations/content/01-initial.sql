@@ -0,0 +1,2 @@
+CREATE TABLE IF NOT EXISTS content (id INTEGER PRIMARY KEY,
+                                    data TEXT);
@@ -0,0 +1,28 @@
+-- Bodies are keyed by a hash of sanitized content, so identical contents of
+-- different items are stored only once. refs is maintained by the triggers
+-- below and bodies are deleted once nothing refers to them anymore.
+CREATE TABLE IF NOT EXISTS bodies (hash BLOB PRIMARY KEY,
+                                   data TEXT,
+                                   refs INTEGER DEFAULT 0);
+
+CREATE TABLE IF NOT EXISTS item_bodies (id INTEGER PRIMARY KEY,
+                                        hash BLOB);
+
+CREATE TRIGGER IF NOT EXISTS item_bodies_insert AFTER INSERT ON item_bodies
+BEGIN
+    UPDATE bodies SET refs=refs+1 WHERE hash=NEW.hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS item_bodies_update AFTER UPDATE OF hash
+                                                ON item_bodies
+BEGIN
+    UPDATE bodies SET refs=refs+1 WHERE hash=NEW.hash;
+    UPDATE bodies SET refs=refs-1 WHERE hash=OLD.hash;
+    DELETE FROM bodies WHERE hash=OLD.hash AND refs<=0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS item_bodies_delete AFTER DELETE ON item_bodies
+BEGIN
+    UPDATE bodies SET refs=refs-1 WHERE hash=OLD.hash;
+    DELETE FROM bodies WHERE hash=OLD.hash AND refs<=0;
+END;
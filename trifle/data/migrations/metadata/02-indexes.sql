@@ -0,0 +1,12 @@
+CREATE INDEX IF NOT EXISTS items_to_sync ON items(to_sync);
+CREATE INDEX IF NOT EXISTS items_to_delete ON items(to_delete);
+CREATE INDEX IF NOT EXISTS items_time ON items(time);
+CREATE INDEX IF NOT EXISTS items_subscription ON items(subscription);
+
+CREATE INDEX IF NOT EXISTS labels_fk_item_id ON labels_fk(item_id);
+
+-- Only the latest change of a flag matters, older ones can't be pushed to
+-- server anyway.
+DELETE FROM flags WHERE id NOT IN (SELECT MAX(id) FROM flags
+                                   GROUP BY item_id, flag);
+CREATE UNIQUE INDEX IF NOT EXISTS flags_item_flag ON flags(item_id, flag);
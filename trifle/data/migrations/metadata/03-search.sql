@@ -0,0 +1,8 @@
+-- Full text index of items. rowid is the id of item.
+CREATE VIRTUAL TABLE IF NOT EXISTS items_search USING fts5(title, author,
+                                                           summary, content);
+
+-- Contents of already cached items will be indexed when they're updated.
+INSERT INTO items_search(rowid, title, author, summary)
+       SELECT id, title, author, summary FROM items
+       WHERE id NOT IN (SELECT rowid FROM items_search);
@@ -0,0 +1,6 @@
+-- Various values synchronizers need to remember between runs
+CREATE TABLE IF NOT EXISTS sync_state (key VARCHAR(64) PRIMARY KEY,
+                                       value);
+
+-- Incremental synchronization asks for items newer than the newest one
+CREATE INDEX IF NOT EXISTS items_update_time ON items(update_time);
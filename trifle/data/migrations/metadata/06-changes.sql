@@ -0,0 +1,72 @@
+-- Generation of the last change of every item, so models can ask for rows
+-- changed since they were updated. Kept up to date by triggers below.
+CREATE TABLE IF NOT EXISTS item_changes (item_id INTEGER PRIMARY KEY,
+                                         generation INTEGER,
+                                         deleted BOOLEAN DEFAULT 0);
+CREATE INDEX IF NOT EXISTS item_changes_generation
+    ON item_changes(generation);
+
+CREATE TRIGGER IF NOT EXISTS items_inserted AFTER INSERT ON items
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    VALUES (NEW.id, (SELECT COALESCE(MAX(generation), 0) + 1
+                     FROM item_changes));
+END;
+
+-- Only columns shown by models are interesting
+CREATE TRIGGER IF NOT EXISTS items_updated AFTER UPDATE ON items
+WHEN OLD.title IS NOT NEW.title OR OLD.summary IS NOT NEW.summary OR
+     OLD.href IS NOT NEW.href OR OLD.time IS NOT NEW.time OR
+     OLD.unread IS NOT NEW.unread OR OLD.starred IS NOT NEW.starred OR
+     OLD.subscription IS NOT NEW.subscription
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    VALUES (NEW.id, (SELECT COALESCE(MAX(generation), 0) + 1
+                     FROM item_changes));
+END;
+
+CREATE TRIGGER IF NOT EXISTS items_deleted AFTER DELETE ON items
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation, deleted)
+    VALUES (OLD.id, (SELECT COALESCE(MAX(generation), 0) + 1
+                     FROM item_changes), 1);
+END;
+
+-- Rows of items carry title and url of their subscription and its labels
+CREATE TRIGGER IF NOT EXISTS subscriptions_inserted
+AFTER INSERT ON subscriptions
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    SELECT id, (SELECT COALESCE(MAX(generation), 0) + 1 FROM item_changes)
+    FROM items WHERE subscription=NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_updated
+AFTER UPDATE ON subscriptions
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    SELECT id, (SELECT COALESCE(MAX(generation), 0) + 1 FROM item_changes)
+    FROM items WHERE subscription IN (OLD.id, NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_deleted
+AFTER DELETE ON subscriptions
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    SELECT id, (SELECT COALESCE(MAX(generation), 0) + 1 FROM item_changes)
+    FROM items WHERE subscription=OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS labels_fk_inserted AFTER INSERT ON labels_fk
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    SELECT id, (SELECT COALESCE(MAX(generation), 0) + 1 FROM item_changes)
+    FROM items WHERE subscription=NEW.item_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS labels_fk_deleted AFTER DELETE ON labels_fk
+BEGIN
+    INSERT OR REPLACE INTO item_changes(item_id, generation)
+    SELECT id, (SELECT COALESCE(MAX(generation), 0) + 1 FROM item_changes)
+    FROM items WHERE subscription=OLD.item_id;
+END;
@@ -1,2 +1,2 @@
 from trifle.models import (auth, feeds, subscriptions, settings, base,
-                           synchronizers)
+                           synchronizers, scheduler)
@@ -1,9 +1,44 @@
+from gi.repository import GLib
 from gi.repository import GObject
+from gi.repository import Soup
+
+from trifle.utils import session
 
 
 class SyncObject(GObject.Object):
     __gsignals__ = {
         'sync-done': (GObject.SignalFlags.RUN_LAST, None, []),
+        # Emitted instead of sync-done when synchronization couldn't complete
+        'sync-failed': (GObject.SignalFlags.RUN_LAST, None, []),
     }
     sync_status = GObject.property(type=object)
     auth = GObject.property(type=GObject.Object)
+    # RetryPolicy for requests, failed requests are not retried if None
+    retry = GObject.property(type=object)
+
+    def __init__(self, *args, **kwargs):
+        super(SyncObject, self).__init__(*args, **kwargs)
+        # Requests in progress, cancelled by cancel()
+        self.messages = set()
+        self.cancelled = False
+
+    def queue(self, msg, callback, data=None):
+        """ Sends request of this synchronization """
+        def on_response(session, msg, data):
+            self.messages.discard(msg)
+            callback(session, msg, data)
+
+        if self.cancelled:
+            msg.set_status(Soup.Status.CANCELLED)
+            GLib.idle_add(callback, session, msg, data)
+            return
+        self.messages.add(msg)
+        session.queue_message(msg, on_response, data, retry=self.retry)
+
+    def cancel(self):
+        """ Cancels requests in progress and any sent later. Callbacks of
+        cancelled requests are called with CANCELLED status, so synchronizer
+        finishes as usual """
+        self.cancelled = True
+        for msg in list(self.messages):
+            session.cancel(msg)
@@ -1,17 +1,148 @@
 # -*- coding:utf-8 -*-
-import os
+import array
+import bisect
+import collections
+
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
 
 from trifle.models import synchronizers
-from trifle.utils import ItemsColumn as Col, CONTENT_PATH, sqlite, StateIds
+from trifle.utils import ItemsColumn as Col, sqlite, StateIds, logger
+
+
+class Memberships(GObject.Object):
+    """
+    Ids of unread and starred items, and of items of every subscription and
+    label. Items shown by a view are found from these, without looking at
+    every row of a model. Numbers of unread and starred items of every
+    subscription are counted as well.
+    """
+    __gsignals__ = {
+        'counts-changed': (GObject.SignalFlags.RUN_LAST, None, []),
+    }
+    categories = ('unread', 'starred')
+
+    def __init__(self, *args, **kwargs):
+        super(Memberships, self).__init__(*args, **kwargs)
+        self.unread, self.starred = set(), set()
+        self.subscription_of = {}
+        self.subscriptions = {}
+        # [unread, starred] of every subscription
+        self.counts = {}
+        self.counts_source = None
+        # Subscriptions of every label
+        self.labels = {}
+        # Strings are shared by all the items of a subscription
+        self.names = {}
+        self.view = ('reading-list', None, False)
+        self.category, self.feed = None, None
+
+    def add(self, item_id, unread, starred, subscription):
+        """ Adds item or updates its memberships """
+        self.discard(item_id)
+        subscription = self.names.setdefault(subscription, subscription)
+        self.subscription_of[item_id] = subscription
+        self.subscriptions.setdefault(subscription, set()).add(item_id)
+        if unread or starred:
+            counts = self.counts.setdefault(subscription, [0, 0])
+            if unread:
+                self.unread.add(item_id)
+                counts[0] += 1
+            if starred:
+                self.starred.add(item_id)
+                counts[1] += 1
+            self.counts_changed()
+
+    def discard(self, item_id):
+        if item_id not in self.subscription_of:
+            return
+        subscription = self.subscription_of.pop(item_id)
+        self.subscriptions[subscription].discard(item_id)
+        if item_id in self.unread or item_id in self.starred:
+            counts = self.counts[subscription]
+            if item_id in self.unread:
+                self.unread.remove(item_id)
+                counts[0] -= 1
+            if item_id in self.starred:
+                self.starred.remove(item_id)
+                counts[1] -= 1
+            self.counts_changed()
+
+    def counts_changed(self):
+        # Changes are usually made in bulk, they're announced once
+        if self.counts_source is None:
+            self.counts_source = GLib.idle_add(self.on_counts_changed)
+
+    def on_counts_changed(self):
+        self.counts_source = None
+        self.emit('counts-changed')
+        return False
+
+    def count(self, subscription):
+        """ Returns (unread, starred) numbers of items of subscription """
+        return tuple(self.counts.get(subscription, (0, 0)))
+
+    def set_labels(self, rows):
+        """ Sets (label, subscription) pairs. Returns whether subscriptions
+        of shown label have changed """
+        self.labels = {}
+        for label, subscription in rows:
+            self.labels.setdefault(label, set()).add(subscription)
+        feed = self.feed
+        self.show(*self.view)
+        return feed != self.feed
+
+    def show(self, category, feed=None, is_label=False):
+        """ Sets view items of which are shown. Category is either one of
+        categories or everything, feed is id of label or subscription or
+        None for all of them """
+        self.view = category, feed, is_label
+        self.category = getattr(self, category) \
+                        if category in self.categories else None
+        if feed is None:
+            self.feed = None
+        elif is_label:
+            self.feed = self.labels.get(feed, set())
+        else:
+            self.feed = {feed}
+
+    def is_shown(self, item_id, forced=()):
+        """ Whether item is in the view. Forced items are shown in any
+        category """
+        if self.category is not None and item_id not in self.category and \
+           item_id not in forced:
+            return False
+        return self.feed is None or self.subscription_of.get(item_id, None) \
+                                    in self.feed
+
+    def shown(self, forced=()):
+        """ Returns ids of all the items in the view """
+        if self.feed is None:
+            shown = set(self.subscription_of)
+        else:
+            shown = set().union(*(self.subscriptions.get(subscription, ())
+                                  for subscription in self.feed))
+        if self.category is not None:
+            shown &= self.category.union(forced)
+        return shown
 
 
 class Store(Gtk.ListStore):
     __gsignals__ = {
         'updated': (GObject.SignalFlags.RUN_LAST, None, []),
     }
+    columns = '''I.title, summary, href, time/1000000, unread, starred, S.url,
+                 S.title, S.id'''
+    query = '''SELECT {columns} FROM {source}
+               LEFT JOIN subscriptions AS S ON S.id=I.subscription {where}
+               ORDER BY time DESC'''
+    # We're the only one interested in deleted items. Next generation is
+    # one after the greatest, so the greatest one is never pruned.
+    prune_query = '''DELETE FROM item_changes
+                     WHERE deleted=1 AND generation <= ? AND
+                           generation < (SELECT MAX(generation)
+                                         FROM item_changes)'''
 
     def __init__(self, *args, **kwargs):
         cols = (object, # Item ID
@@ -24,65 +155,227 @@ class Store(Gtk.ListStore):
                 GObject.TYPE_STRING, # Subscription URI
                 GObject.TYPE_STRING, # Subscription Title
                 GObject.TYPE_STRING, # Subscription ID
-                GObject.TYPE_STRING, # Label ID
+                GObject.TYPE_BOOLEAN, # Is item in the shown view
                 GObject.TYPE_BOOLEAN) # Forced visibility
         super(Store, self).__init__(*(cols + args), **kwargs)
         # Items with forced visibility
         self.forced = set()
-
-        if not os.path.exists(CONTENT_PATH):
-            os.makedirs(CONTENT_PATH)
+        # Generation of item_changes model is up to date with
+        self.generation = None
+        # Iter of row of every item. ListStore iters stay valid until the
+        # row is removed, sorting included, so this is kept up to date by
+        # everything that appends or removes rows.
+        self.rows = {}
+        # VISIBLE column is kept up to date with these
+        self.members = Memberships()
+        self.visible = set()
+        # Overlapping updates would load rows twice, thus updates asked for
+        # while one is running are done after it, once.
+        self.updating = False
+        self.update_pending = False
 
         self.row_ch_handler = self.connect('row-changed', self.on_changed)
 
     def unread_count(self):
-        return len(list(filter(lambda x: x[Col.UNREAD], self)))
+        return len(self.members.unread)
 
     def update(self):
-        self.set_sort_column_id(-2, Gtk.SortType.DESCENDING) # Unsorted
-        self.handler_block(self.row_ch_handler)
+        """ Brings model up to date with the database. Only the first update
+        loads all the items, later ones apply changes since the last one """
+        if self.updating:
+            self.update_pending = True
+            return
+        self.updating = True
+        # There are few labels, they are loaded anew every time
+        query = 'SELECT label_id, item_id FROM labels_fk'
+        sqlite.select(query).connect('finished', self.on_labels)
 
-        query = '''SELECT I.id, I.title, summary, href, time/1000000, unread,
-                   starred, S.url, S.title, S.id, label_id FROM items AS I
-                   LEFT JOIN subscriptions AS S ON S.id=I.subscription
-                   LEFT JOIN labels_fk AS L ON L.item_id=S.id
-                   ORDER BY time DESC'''
-        sqlite.execute(query).connect('finished', self.on_update_content)
+    def on_labels(self, job, success):
+        if not success:
+            logger.error('Failed to get labels from SQLite')
+            self.update_done()
+            return
+        if self.members.set_labels(job.result):
+            self.refilter()
+        query = 'SELECT MAX(generation) FROM item_changes'
+        sqlite.select(query).connect('finished', self.on_generation)
 
-    def on_update_content(self, job, success):
+    def on_generation(self, job, success):
         if not success:
             logger.error('Failed to get items from SQLite')
+            self.update_done()
+            return
+        # Changes made after this point will be applied by the next update
+        generation = job.result[0][0] or 0
+        if self.generation is None:
+            self.load(generation)
             return
-        exists = {r[Col.ID]: self.get_iter(key) for key, r in enumerate(self)}
-        for item in job.result:
-            if item[0] in exists:
+
+        columns = 'C.item_id, {0}, C.deleted OR I.id IS NULL'.format(
+                  self.columns)
+        source = 'item_changes AS C LEFT JOIN items AS I ON I.id=C.item_id'
+        query = self.query.format(columns=columns, source=source,
+                                  where='WHERE C.generation > ?')
+        changed = {}
+        job = sqlite.select(query, (self.generation,), page_size=500)
+        job.connect('rows', self.on_changed_rows, changed)
+        job.connect('finished', self.on_changes, (changed, generation))
+
+    def load(self, generation):
+        self.set_sort_column_id(-2, Gtk.SortType.DESCENDING) # Unsorted
+        query = self.query.format(columns='I.id, ' + self.columns,
+                                  source='items AS I', where='')
+        # Iters of items we've received, existing ones are reused.
+        received = {}
+        job = sqlite.select(query, page_size=500)
+        job.connect('rows', self.on_update_rows, received)
+        job.connect('finished', self.on_update_content, (received, generation))
+
+    def on_update_rows(self, job, rows, received):
+        self.handler_block(self.row_ch_handler)
+        for item in rows:
+            itr = self.rows.get(item[Col.ID])
+            item += (self.track(item),)
+            if itr is not None:
                 v = zip(*filter(lambda x: x[1] is not None, enumerate(item)))
-                self.set(exists[item[Col.ID]], *v)
+                self.set(itr, *v)
             else:
-                self.append(item + (False,))
-        # Remove items we do not have anymore
-        for removed_id in set(exists.keys()) - set(i[Col.ID] for i in
-                                                   job.result):
-            self.remove(exists[removed_id])
+                itr = self.append(item + (False,))
+            received[item[Col.ID]] = itr
+        self.handler_unblock(self.row_ch_handler)
+
+    def on_update_content(self, job, success, data):
+        received, generation = data
+        if not success:
+            logger.error('Failed to get items from SQLite')
+            self.update_done()
+            return
+        # Remove rows we do not have anymore
+        self.handler_block(self.row_ch_handler)
+        for item_id, itr in self.rows.items():
+            if item_id not in received:
+                self.remove(itr)
+                self.untrack(item_id)
+        self.handler_unblock(self.row_ch_handler)
+        self.rows = received
+        self.on_updated(generation)
 
+    def on_changed_rows(self, job, rows, changed):
+        for row in rows:
+            changed[row[Col.ID]] = row
+
+    def on_changes(self, job, success, data):
+        changed, generation = data
+        if not success:
+            logger.error('Failed to get changed items from SQLite')
+            self.update_done()
+            return
+        self.set_sort_column_id(-2, Gtk.SortType.DESCENDING) # Unsorted
+        self.handler_block(self.row_ch_handler)
+        for item_id, row in changed.items():
+            itr = self.rows.pop(item_id, None)
+            # Last column tells whether item was deleted
+            if row[-1]:
+                self.untrack(item_id)
+                if itr is not None:
+                    self.remove(itr)
+                continue
+            item = row[:-1]
+            item += (self.track(item),)
+            # Existing rows are reused, so selection and such stay intact
+            if itr is not None:
+                v = zip(*filter(lambda x: x[1] is not None, enumerate(item)))
+                self.set(itr, *v)
+            else:
+                itr = self.append(item + (False,))
+            self.rows[item_id] = itr
         self.handler_unblock(self.row_ch_handler)
+        logger.debug('Applied changes of {0} items'.format(len(changed)))
+        self.on_updated(generation)
+
+    def on_updated(self, generation):
+        self.generation = generation
+        sqlite.execute(self.prune_query, (generation,))
+        sqlite.commit()
         self.set_sort_column_id(Col.TIMESTAMP, Gtk.SortType.DESCENDING)
         GLib.idle_add(self.emit, 'updated')
+        self.update_done()
+
+    def update_done(self):
+        self.updating = False
+        if self.update_pending:
+            self.update_pending = False
+            self.update()
+
+    def search(self, text, limit=100):
+        """ Searches titles, authors and contents of items. Returns a job,
+        result of which will be a list of (id,) tuples, most relevant first.
+        Without any words to search for these are the newest items instead.
+        """
+        if not text.split():
+            # Empty MATCH query would be a syntax error
+            query = 'SELECT id FROM items ORDER BY time DESC LIMIT ?'
+            return sqlite.select(query, (limit,))
+        # Make every word a prefix query, so user doesn't need to know about
+        # FTS query syntax, nor to type whole words.
+        terms = ('"{0}"*'.format(t.replace('"', '""')) for t in text.split())
+        query = '''SELECT rowid FROM items_search WHERE items_search MATCH ?
+                   ORDER BY rank LIMIT ?'''
+        return sqlite.select(query, (' '.join(terms), limit))
+
+    def iter_of(self, item_id):
+        """ Returns iter of row of item or None """
+        return self.rows.get(item_id)
+
+    def track(self, item):
+        """ Updates memberships of item from values of its row. Returns
+        whether item is visible """
+        item_id = item[Col.ID]
+        self.members.add(item_id, item[Col.UNREAD], item[Col.STARRED],
+                         item[Col.SUB_ID])
+        if self.members.is_shown(item_id, self.forced):
+            self.visible.add(item_id)
+            return True
+        self.visible.discard(item_id)
+        return False
+
+    def untrack(self, item_id):
+        self.members.discard(item_id)
+        self.visible.discard(item_id)
+
+    def show(self, category, feed=None, is_label=False):
+        """ Makes only items of category and of subscription or label feed
+        visible. Only rows which change visibility are touched """
+        self.members.show(category, feed, is_label)
+        self.refilter()
+
+    def refilter(self):
+        shown = self.members.shown(self.forced)
+        self.handler_block(self.row_ch_handler)
+        for item_id in shown.symmetric_difference(self.visible):
+            itr = self.iter_of(item_id)
+            if itr is not None:
+                self.set_value(itr, Col.VISIBLE, item_id in shown)
+        self.handler_unblock(self.row_ch_handler)
+        self.visible = shown
 
     def unforce_all(self):
-        if len(self.forced) == 0:
-            return
-        for row in (row for row in self if row[Col.ID] in self.forced):
-            self.forced.remove(row[Col.ID])
-            row[Col.FORCE_VISIBLE] = False
-            if len(self.forced) == 0:
-                break
+        forced, self.forced = self.forced, set()
+        for item_id in forced:
+            itr = self.iter_of(item_id)
+            if itr is not None:
+                self.set_value(itr, Col.FORCE_VISIBLE, False)
 
     @staticmethod
     def on_changed(self, path, itr):
         row = self[itr]
         if row[Col.FORCE_VISIBLE] == True:
             self.forced.add(row[Col.ID])
+        visible = self.track(row)
+        if row[Col.VISIBLE] != visible:
+            self.handler_block(self.row_ch_handler)
+            row[Col.VISIBLE] = visible
+            self.handler_unblock(self.row_ch_handler)
         query = '''UPDATE items SET unread=?, starred=? WHERE id=?'''
         sqlite.execute(query, (row[Col.UNREAD], row[Col.STARRED],
                                      row[Col.ID],))
@@ -92,8 +385,331 @@ class Store(Gtk.ListStore):
         sqlite.commit()
 
     def add_flag(self, item_id, flag, value):
-        query = '''INSERT OR REPLACE INTO flags(item_id, flag, remove, id)
-                   VALUES (:id, :flag, :remove,
-                   (SELECT id FROM flags WHERE item_id=:id AND flag=:flag))'''
+        # Replacing the row gives it a new id, thus a push of the previous
+        # value which is still in progress will not remove this one.
+        query = '''INSERT OR REPLACE INTO flags(item_id, flag, remove)
+                   VALUES (:id, :flag, :remove)'''
         sqlite.execute(query, {'id': item_id, 'flag': flag,
                                      'remove': not value})
+
+
+class PagedStore(GObject.Object, Gtk.TreeModel):
+    """
+    Alternative to Store for very large caches. Only ids, timestamps and
+    flags of rows are kept, in compact arrays, and memberships of items.
+    Titles, summaries and such are fetched from SQLite a page at a time as
+    views ask for them and only a limited number of them is kept around.
+    Until a page arrives its rows have no text.
+    """
+    __gsignals__ = {
+        'updated': (GObject.SignalFlags.RUN_LAST, None, []),
+    }
+    column_types = (object, str, str, str, GObject.TYPE_UINT64, bool, bool,
+                    str, str, str, bool, bool)
+    # Columns kept in memory, rest of them are fetched on demand
+    columns = 'time/1000000, unread, starred, S.id'
+    query = Store.query
+    prune_query = Store.prune_query
+    fetch_query = '''SELECT I.id, I.title, summary, href, S.url, S.title
+                     FROM items AS I
+                     LEFT JOIN subscriptions AS S ON S.id=I.subscription
+                     WHERE I.id IN ({0})'''
+    fetched = {Col.TITLE: 0, Col.SUMMARY: 1, Col.LINK: 2, Col.SUB_URI: 3,
+               Col.SUB_TITLE: 4}
+    flag_bits = {Col.UNREAD: 1, Col.STARRED: 2, Col.FORCE_VISIBLE: 4}
+    page_size = 100
+    # Rows of fetched columns kept in memory
+    cache_size = 2000
+
+    def __init__(self, *args, **kwargs):
+        super(PagedStore, self).__init__(*args, **kwargs)
+        # Rows are sorted by time, newest first. keys hold negated
+        # timestamps, so position of a new row is found with bisect.
+        self.ids = array.array('q')
+        self.keys = array.array('q')
+        self.flags = bytearray()
+        # Key of every item, to find its rows with bisect
+        self.key_of = {}
+        # Subscriptions of items and whether they're visible
+        self.members = Memberships()
+        # Fetched columns of items, least recently used first
+        self.cache = collections.OrderedDict()
+        self.fetching = set()
+        self.forced = set()
+        self.generation = None
+        self.updating = False
+        self.update_pending = False
+
+    def iter_at(self, position):
+        itr = Gtk.TreeIter()
+        # user_data of 0 would be a NULL pointer
+        itr.user_data = position + 1
+        return itr
+
+    def position(self, item_id):
+        """ Returns position of row of item or None """
+        key = self.key_of.get(item_id)
+        if key is None:
+            return None
+        # Only rows with the same timestamp are looked at
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, start)
+        for position in range(start, end):
+            if self.ids[position] == item_id:
+                return position
+        return None
+
+    def iter_of(self, item_id):
+        """ Returns iter of row of item or None """
+        position = self.position(item_id)
+        return None if position is None else self.iter_at(position)
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.column_types)
+
+    def do_get_column_type(self, column):
+        return self.column_types[column]
+
+    def do_get_iter(self, path):
+        position = path.get_indices()[0]
+        if position < len(self.ids):
+            return True, self.iter_at(position)
+        return False, None
+
+    def do_get_path(self, itr):
+        return Gtk.TreePath(itr.user_data - 1)
+
+    def do_iter_next(self, itr):
+        position = itr.user_data
+        if position < len(self.ids):
+            itr.user_data = position + 1
+            return True, itr
+        return False, None
+
+    def do_iter_children(self, parent):
+        if parent is None and len(self.ids) > 0:
+            return True, self.iter_at(0)
+        return False, None
+
+    def do_iter_has_child(self, itr):
+        return False
+
+    def do_iter_n_children(self, itr):
+        return len(self.ids) if itr is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.ids):
+            return True, self.iter_at(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
+
+    def do_get_value(self, itr, column):
+        position = itr.user_data - 1
+        if column == Col.ID:
+            return self.ids[position]
+        elif column == Col.TIMESTAMP:
+            return -self.keys[position]
+        elif column in self.flag_bits:
+            return bool(self.flags[position] & self.flag_bits[column])
+        elif column == Col.SUB_ID:
+            return self.members.subscription_of.get(self.ids[position])
+        elif column == Col.VISIBLE:
+            return self.members.is_shown(self.ids[position], self.forced)
+        row = self.cache.get(self.ids[position])
+        if row is None:
+            self.fetch(position)
+            return None
+        self.cache.move_to_end(self.ids[position])
+        return row[self.fetched[column]]
+
+    def set_value(self, itr, column, value):
+        """ Sets flag of row """
+        if column not in self.flag_bits:
+            logger.error('Column {0} of PagedStore is read only'
+                                                            .format(column))
+            return
+        position = itr.user_data - 1
+        item_id = self.ids[position]
+        bit = self.flag_bits[column]
+        if value:
+            self.flags[position] |= bit
+        else:
+            self.flags[position] &= ~bit
+        # Filters read VISIBLE, which depends on these, on row_changed
+        if column == Col.FORCE_VISIBLE:
+            if value:
+                self.forced.add(item_id)
+            else:
+                self.forced.discard(item_id)
+            self.row_changed(Gtk.TreePath(position), self.iter_at(position))
+            return
+        flags = self.flags[position]
+        self.members.add(item_id, flags & self.flag_bits[Col.UNREAD],
+                         flags & self.flag_bits[Col.STARRED],
+                         self.members.subscription_of.get(item_id))
+        self.row_changed(Gtk.TreePath(position), self.iter_at(position))
+        column = 'unread' if column == Col.UNREAD else 'starred'
+        query = 'UPDATE items SET {0}=? WHERE id=?'.format(column)
+        sqlite.execute(query, (value, item_id,))
+        if column == 'unread':
+            self.add_flag(item_id, StateIds.READ, not value)
+            self.add_flag(item_id, StateIds.KEPT_UNREAD, value)
+        else:
+            self.add_flag(item_id, StateIds.STARRED, value)
+        sqlite.commit()
+
+    def fetch(self, position):
+        """ Fetches columns of all rows on the page of position """
+        start = position - position % self.page_size
+        ids = set(self.ids[start:start + self.page_size])
+        ids.difference_update(self.cache, self.fetching)
+        if not ids:
+            return
+        self.fetching.update(ids)
+        query = self.fetch_query.format(', '.join('?' * len(ids)))
+        job = sqlite.select(query, tuple(ids))
+        job.connect('finished', self.on_fetched, (start, ids))
+
+    def on_fetched(self, job, success, data):
+        start, ids = data
+        self.fetching.difference_update(ids)
+        if not success:
+            logger.error('Failed to fetch rows of items from SQLite')
+            return
+        for row in job.result:
+            self.cache[row[0]] = row[1:]
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        # Views show rows we did not have before. Rows might have moved
+        # since the page was requested, those are redrawn whenever they're
+        # asked for again.
+        end = min(start + self.page_size, len(self.ids))
+        for position in range(start, end):
+            if self.ids[position] in ids:
+                self.row_changed(Gtk.TreePath(position),
+                                 self.iter_at(position))
+
+    def show(self, category, feed=None, is_label=False):
+        """ Makes only items of category and of subscription or label feed
+        visible. Views should filter the model anew afterwards """
+        self.members.show(category, feed, is_label)
+
+    def refilter(self):
+        for position in range(len(self.ids)):
+            self.row_changed(Gtk.TreePath(position), self.iter_at(position))
+
+    def on_generation(self, job, success):
+        if not success:
+            logger.error('Failed to get items from SQLite')
+            self.update_done()
+            return
+        generation = job.result[0][0] or 0
+        if self.generation is None:
+            query = self.query.format(columns='I.id, ' + self.columns,
+                                      source='items AS I', where='')
+            job = sqlite.select(query, page_size=5000)
+            job.connect('rows', self.on_loaded_rows)
+            job.connect('finished', self.on_loaded, generation)
+            return
+
+        columns = 'C.item_id, {0}, C.deleted OR I.id IS NULL'.format(
+                  self.columns)
+        source = 'item_changes AS C LEFT JOIN items AS I ON I.id=C.item_id'
+        query = self.query.format(columns=columns, source=source,
+                                  where='WHERE C.generation > ?')
+        changed = {}
+        job = sqlite.select(query, (self.generation,), page_size=5000)
+        job.connect('rows', self.on_changed_rows, changed)
+        job.connect('finished', self.on_changes, (changed, generation))
+
+    def pack(self, unread, starred):
+        return (self.flag_bits[Col.UNREAD] if unread else 0) | \
+               (self.flag_bits[Col.STARRED] if starred else 0)
+
+    def append(self, row):
+        # Rows arrive sorted already
+        self.insert(len(self.ids), row)
+
+    def insert(self, position, row):
+        item_id, time, unread, starred, subscription = row
+        self.ids.insert(position, item_id)
+        self.keys.insert(position, -(time or 0))
+        self.key_of[item_id] = -(time or 0)
+        self.flags.insert(position, self.pack(unread, starred))
+        self.members.add(item_id, unread, starred, subscription)
+        self.row_inserted(Gtk.TreePath(position), self.iter_at(position))
+
+    def delete(self, position):
+        self.members.discard(self.ids[position])
+        self.key_of.pop(self.ids[position], None)
+        for column in (self.ids, self.keys, self.flags):
+            del column[position]
+        self.row_deleted(Gtk.TreePath(position))
+
+    def on_loaded_rows(self, job, rows):
+        for row in rows:
+            self.append(row)
+
+    def on_loaded(self, job, success, generation):
+        if not success:
+            logger.error('Failed to get items from SQLite')
+            self.update_done()
+            return
+        self.on_updated(generation)
+
+    def on_changes(self, job, success, data):
+        changed, generation = data
+        if not success:
+            logger.error('Failed to get changed items from SQLite')
+            self.update_done()
+            return
+        for item_id, row in changed.items():
+            self.cache.pop(item_id, None)
+            position = self.position(item_id)
+            deleted, row = row[-1], row[:-1]
+            time = row[1] or 0
+            # Rows which stay in place are changed, so selection and such
+            # stay intact
+            if position is not None and not deleted and \
+               self.keys[position] == -time:
+                forced = self.flags[position] & \
+                         self.flag_bits[Col.FORCE_VISIBLE]
+                unread, starred, subscription = row[2:]
+                self.flags[position] = self.pack(unread, starred) | forced
+                self.members.add(item_id, unread, starred, subscription)
+                self.row_changed(Gtk.TreePath(position),
+                                 self.iter_at(position))
+                continue
+            if position is not None:
+                self.delete(position)
+            if not deleted:
+                self.insert(bisect.bisect_right(self.keys, -time), row)
+        logger.debug('Applied changes of {0} items'.format(len(changed)))
+        self.on_updated(generation)
+
+    def on_updated(self, generation):
+        self.generation = generation
+        sqlite.execute(self.prune_query, (generation,))
+        sqlite.commit()
+        GLib.idle_add(self.emit, 'updated')
+        self.update_done()
+
+    def unforce_all(self):
+        forced, self.forced = self.forced, set()
+        for item_id in forced:
+            itr = self.iter_of(item_id)
+            if itr is not None:
+                self.set_value(itr, Col.FORCE_VISIBLE, False)
+
+    unread_count = Store.unread_count
+    update = Store.update
+    on_labels = Store.on_labels
+    update_done = Store.update_done
+    on_changed_rows = Store.on_changed_rows
+    add_flag = Store.add_flag
+    search = Store.search
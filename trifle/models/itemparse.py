@@ -1,15 +1,101 @@
 import json
-import os
+import lxml.etree
 import lxml.html
 import lxml.html.clean
+import re
 
-from trifle.utils import short_id, CONTENT_PATH
+from trifle.utils import short_id, content as content_store
 
-def process_item(item):
+class Sanitizer(object):
+    """
+    Cleans up HTML of item contents. Meant to be created once and reused for
+    all the items, as setting it up is not free.
+    """
+    # Attributes removed from all elements
+    remove_attributes = ('width', 'height', 'color', 'size', 'align',
+                         'background', 'bgcolor', 'border', 'cellpadding',
+                         'cellspacing',)
+    header_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self):
+        # Everything we need to modify is found in a single walk of the tree
+        paths = ['//iframe'] + ['//' + tag for tag in self.header_tags]
+        paths.append('//*[{0}]'.format(' or '.join('@' + a for a in
+                                                   self.remove_attributes)))
+        self.xpath = lxml.etree.XPath('|'.join(paths))
+        self.cleaner = lxml.html.clean.Cleaner(remove_tags=['font'])
+
+    def __call__(self, content):
+        """ Returns (summary, sanitized content, text) tuple """
+        # Put fragments all under one element for easier manipulation
+        main = lxml.html.fragment_fromstring(content, create_parent='div')
+
+        # Get summary text before all the modifications.
+        summary = main.text_content().replace('\n', ' ').strip()[:250]
+
+        iframes, headers = [], []
+        for el in self.xpath(main):
+            attrib = el.attrib
+            for attr in self.remove_attributes:
+                if attr in attrib:
+                    attrib.pop(attr)
+            if el.tag == 'iframe':
+                iframes.append(el)
+            elif el.tag in self.header_tags:
+                headers.append(el)
+
+        # Replace all iframes with regular link
+        for iframe in iframes:
+            src = iframe.get('src')
+            if not src:
+                iframe.getparent().remove(iframe)
+                continue
+            link = lxml.html.HtmlElement(src, attrib={
+                                                'href': src,
+                                                'class': 'trifle_iframe'})
+            link.tag = 'a'
+            # Links can't be nested, link goes right after the enclosing one
+            anchor = next(iframe.iterancestors('a'), None)
+            if anchor is None:
+                iframe.getparent().replace(iframe, link)
+            else:
+                iframe.drop_tree()
+                link.tail, anchor.tail = anchor.tail, None
+                anchor.addnext(link)
+
+        # Re-level headers. Make sure highest header level is h1 and they
+        # decrease by steps of one.
+        used_header_tags = sorted({header.tag for header in headers})
+        header_tag_mapping = dict(zip(used_header_tags, self.header_tags))
+        for header in headers:
+            header.tag = header_tag_mapping[header.tag]
+
+        # Cleaner works on the tree in place, no need to serialize it first
+        self.cleaner(main)
+        content = lxml.html.tostring(main, encoding='unicode')
+        # Text for full text search index
+        return summary, content, main.text_content()
+
+    @staticmethod
+    def title(title):
+        """ Returns plain text of title """
+        if '<' in title or '&' in title:
+            title = lxml.html.fromstring(title).text_content()
+        # Not every version of libxml2 normalizes line breaks and plain titles
+        # are not parsed at all
+        title = title.replace('\r\n', '\n').replace('\r', '\n')
+        return title.replace('\n', ' ').strip()
+
+sanitize = Sanitizer()
+
+
+def process_item(item, known_hash=None):
     """
     Should return a (dictionary, content,) pair.
-    Dictionary should contain subscription, time, href, author, title and
-    summary fields.
+    Dictionary should contain subscription, time, href, author, title,
+    summary, text (of sanitized content) and content_hash fields.
+    If hash of the content is equal to known_hash, content is not sanitized
+    again, content is None and there are no summary and text fields.
     If any of values doesn't exist, they'll be replaced with meaningful
     defaults. For example "Unknown" for author or "Untitled item" for
     title
@@ -20,60 +106,14 @@ def process_item(item):
     # understanding teenage girls' thought processes.
     content = item['content']['content'] if 'content' in item else \
               item['summary']['content'] if 'summary' in item else ''
-
-    fragments = lxml.html.fragments_fromstring(content)
-    main = lxml.html.HtmlElement()
-    main.tag = 'div'
-    # Put fragments all under one element for easier manipulation
-    if len(fragments) > 0 and isinstance(fragments[0], str):
-        main.text = fragments[0]
-        del fragments[0]
-    for key, fragment in enumerate(fragments):
-        if isinstance(fragment, lxml.html.HtmlElement):
-            main.append(fragment)
-        else:
-            main[-1].tail = fragment
-
-    # Get summary text before all the modifications.
-    summary = main.text_content().replace('\n', ' ').strip()[:250]
-
-    # Replace all iframes with regular link
-    for iframe in main.xpath('//iframe'):
-        src = iframe.get('src')
-        if not src:
-            iframe.getparent().remove(iframe)
-        else:
-            link = lxml.html.HtmlElement(src, attrib = {
-                                                    'href': src,
-                                                    'class':'trifle_iframe'})
-            link.tag = 'a'
-            iframe.getparent().replace(iframe, link)
-
-    # Remove following attributes from elements
-    remove = ('width', 'height', 'color', 'size', 'align', 'background',
-              'bgcolor', 'border', 'cellpadding', 'cellspacing',)
-    xpath = '//*[{0}]'.format(' or '.join('@'+a for a in remove))
-    for el in main.xpath(xpath):
-        attrib = el.attrib
-        for attr in remove:
-            if attr in attrib:
-                attrib.pop(attr)
-
-    # Re-level headers. Make sure highest header level is h1 and they decrease
-    # by steps of one.
-    all_header_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
-    # //h1|//h2|//h3|//h4...
-    used_headers = main.xpath('|'.join('//' + tag for tag in all_header_tags))
-    used_header_tags = {header.tag for header in used_headers}
-    header_tag_mapping = dict(zip(sorted(used_header_tags), all_header_tags))
-    for header in used_headers:
-        header.tag = header_tag_mapping[header.tag]
-
-
-    content = lxml.html.tostring(main, encoding='unicode')
-    cleaner = lxml.html.clean.Cleaner()
-    cleaner.remove_tags = ['font']
-    content = cleaner.clean_html(content)
+    content_hash = content_store.digest(content)
+    if content_hash == known_hash:
+        metadata = {'content_hash': content_hash}
+        content = None
+    else:
+        summary, content, text = sanitize(content)
+        metadata = {'summary': summary, 'text': text,
+                    'content_hash': content_hash}
 
     time = int(item['timestampUsec'])
     if time >= int(item.get('updated', -1)) * 1E6:
@@ -85,28 +125,99 @@ def process_item(item):
 
     title = item.get('title', None)
     if title is not None:
-        title = lxml.html.fromstring(title).text_content().replace('\n', ' ')
-        title = title.strip()
+        title = sanitize.title(title)
 
-    return {'title': title, 'summary': summary, 'href': href,
-            'author': item.get('author', None), 'time': time,
-            'subscription': item['origin']['streamId']}, content
+    metadata.update({'title': title, 'href': href, 'time': time,
+                     'author': item.get('author', None),
+                     'subscription': item['origin']['streamId']})
+    return metadata, content
 
 
-def process_items(data):
-    data = json.loads(data)
-    resp = []
-    for item in data['items']:
+def warm():
+    """ Initializer of parse workers. Gets lxml parser and sanitizer ready
+    before the first item arrives """
+    sanitize('<p>a</p>')
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def iter_array(text, key):
+    """
+    Yields elements of array `key` of JSON object in `text` (str or UTF-8
+    encoded bytes) one at a time. Unlike json.loads it doesn't keep the whole
+    decoded document in memory.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    skip = lambda pos: _whitespace.match(text, pos).end()
+
+    def expect(char, pos):
+        if text[pos] != char:
+            raise ValueError('Expected {0!r} at {1}'.format(char, pos))
+        return skip(pos + 1)
+
+    pos = expect('{', skip(0))
+    while text[pos] != '}':
+        name, pos = _decoder.raw_decode(text, pos)
+        pos = expect(':', skip(pos))
+        if name == key:
+            pos = expect('[', pos)
+            while text[pos] != ']':
+                value, pos = _decoder.raw_decode(text, pos)
+                yield value
+                pos = skip(pos)
+                if text[pos] == ',':
+                    pos = skip(pos + 1)
+            pos = skip(pos + 1)
+        else:
+            # Other values are small, decode and forget them
+            pos = skip(_decoder.raw_decode(text, pos)[1])
+        if text[pos] == ',':
+            pos = skip(pos + 1)
+
+
+def process_items(data, hashes={}, store_every=50):
+    """ Processes items of stream/items/contents response given as bytes.
+    hashes maps ids of items to hashes of contents we already have.
+    Contents are stored every `store_every` items, so only a handful of them
+    are kept in memory at once """
+    resp, contents = [], []
+    for item in iter_array(data, 'items'):
         sid = short_id(item['id'])
-        metadata, content = process_item(item)
-        # There's no need to replace this one with asynchronous operation as
-        # we do everything here in another process anyway.
-        fpath = os.path.join(CONTENT_PATH, str(sid))
-        with open(fpath, 'w') as f:
-            f.write(content)
+        metadata, content = process_item(item, hashes.get(int(sid)))
+        if content is not None:
+            contents.append((int(sid), content))
         metadata.update({'id': sid})
         resp.append(metadata)
+        if len(contents) >= store_every:
+            content_store.store(contents)
+            contents = []
+    # There's no need to replace this one with asynchronous operation as
+    # we do everything here in another process anyway.
+    content_store.store(contents)
     return resp
 
 
-
+def parse_items(data):
+    """ Same as process_items, but doesn't store anything. For benchmarks """
+    return [process_item(item) for item in iter_array(data, 'items')]
+
+
+def sample(count=50):
+    """ Builds stream/items/contents response with `count` made up items """
+    paragraph = '<p style="color: red">Lorem <b>ipsum</b> dolor sit amet, ' \
+                '<a href="http://example.com">consectetur</a> adipiscing ' \
+                'elit.<font size="2">Sed</font> do eiusmod tempor.</p>'
+    items = [{'id': 'tag:google.com,2005:reader/item/{0:016x}'.format(i),
+              # Titles with line breaks must come out the same as before
+              'title': ('Item <i>{0}</i>' if i % 2 else 'Item\r\n{0}')
+                       .format(i), 'author': 'Author',
+              'timestampUsec': '1360000000000000', 'updated': 1360000000,
+              'alternate': [{'href': 'http://example.com/{0}'.format(i)}],
+              'origin': {'streamId': 'feed/http://example.com/feed'},
+              'content': {'content': '<h3>Heading</h3>' + paragraph * 20 +
+                                     '<iframe src="http://example.com"/>'}}
+             for i in range(count)]
+    return json.dumps({'items': items}).encode('utf-8')
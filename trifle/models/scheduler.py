@@ -0,0 +1,238 @@
+from collections import namedtuple, OrderedDict
+from gi.repository import GLib
+from gi.repository import GObject
+
+from trifle.utils import logger
+
+
+StageState = namedtuple('StageState', 'PENDING RUNNING DONE FAILED '
+                                      'CANCELLED')(*range(5))
+
+
+class Stage(object):
+    def __init__(self, name, synchronizer, after, timeout):
+        self.name, self.synchronizer = name, synchronizer
+        self.after, self.timeout = tuple(after), timeout
+        self.state = StageState.PENDING
+        self.start = self.end = None
+        self.handlers, self.timeout_id = [], None
+        # Timed out stage, synchronizer of which is still being stopped
+        self.stopping = False
+
+    @property
+    def duration(self):
+        """ Time stage was running for in seconds """
+        if self.start is None:
+            return None
+        end = self.end if self.end is not None else GLib.get_monotonic_time()
+        return (end - self.start) / 1E6
+
+
+class Scheduler(GObject.Object):
+    """
+    Runs SyncObjects as stages of synchronization. Each stage is started as
+    soon as all stages it depends on are done, thus independent stages run
+    concurrently. When stage fails, makes no progress for too long or
+    scheduler is cancelled, stages depending on it are cancelled, while
+    others still run.
+
+    Synchronizer of a stage which made no progress is cancelled, and the
+    scheduler finishes only after it stops, so it can't overlap with the
+    next synchronization.
+    """
+    __gsignals__ = {
+        'stage-done': (GObject.SignalFlags.RUN_LAST, None, [str, bool]),
+        'finished': (GObject.SignalFlags.RUN_LAST, None, [bool])
+    }
+    # Default amount of seconds stage may run for without any progress
+    timeout = 300
+
+    def __init__(self, *args, **kwargs):
+        super(Scheduler, self).__init__(*args, **kwargs)
+        self.stages = OrderedDict()
+        self.running = False
+
+    def add(self, name, synchronizer, after=(), timeout=None):
+        """ Adds a stage, which will be run after stages named in `after` """
+        if self.running:
+            raise RuntimeError('Cannot add stages to running scheduler')
+        unknown = set(after) - set(self.stages)
+        if unknown:
+            raise ValueError('Unknown stages {0}'.format(', '.join(unknown)))
+        timeout = self.timeout if timeout is None else timeout
+        self.stages[name] = Stage(name, synchronizer, after, timeout)
+        return synchronizer
+
+    def run(self):
+        self.running = True
+        self._schedule()
+
+    def cancel(self):
+        """ Cancels running stages, stops waiting for them and doesn't start
+        pending ones """
+        for stage in self.stages.values():
+            if stage.stopping:
+                stage.stopping = False
+                self._disconnect(stage)
+            elif stage.state in (StageState.PENDING, StageState.RUNNING):
+                running = stage.state == StageState.RUNNING
+                self._finish_stage(stage, StageState.CANCELLED)
+                if running:
+                    stage.synchronizer.cancel()
+        self._schedule()
+
+    def _schedule(self):
+        for stage in self.stages.values():
+            if stage.state != StageState.PENDING:
+                continue
+            states = {self.stages[name].state for name in stage.after}
+            if states & {StageState.FAILED, StageState.CANCELLED}:
+                logger.debug('Stage {0} cancelled'.format(stage.name))
+                self._finish_stage(stage, StageState.CANCELLED)
+            elif states <= {StageState.DONE}:
+                self._start_stage(stage)
+
+        states = {stage.state for stage in self.stages.values()}
+        stopping = any(stage.stopping for stage in self.stages.values())
+        if self.running and not stopping and \
+           not states & {StageState.PENDING, StageState.RUNNING}:
+            self.running = False
+            summary = ', '.join('{0} {1:.2f}s'.format(s.name, s.duration)
+                                for s in self.stages.values()
+                                if s.duration is not None)
+            logger.debug('Synchronization stages finished: {0}'
+                         .format(summary))
+            self.emit('finished', states == {StageState.DONE})
+
+    def _start_stage(self, stage):
+        logger.debug('Stage {0} started'.format(stage.name))
+        stage.state = StageState.RUNNING
+        stage.start = GLib.get_monotonic_time()
+        sync = stage.synchronizer
+        stage.handlers = [
+            sync.connect('sync-done', self.on_stage_done, stage),
+            sync.connect('sync-failed', self.on_stage_failed, stage),
+            sync.connect('notify::sync-status', self.on_stage_progress, stage)
+        ]
+        self._restart_timeout(stage)
+        if sync.sync() is False:
+            # Stages depending on this one are handled by _schedule, which
+            # visits stages in order they were added.
+            self._finish_stage(stage, StageState.FAILED)
+
+    def _restart_timeout(self, stage):
+        if stage.timeout_id is not None:
+            GLib.source_remove(stage.timeout_id)
+        stage.timeout_id = GLib.timeout_add_seconds(stage.timeout,
+                                                    self.on_stage_timeout,
+                                                    stage)
+
+    def _disconnect(self, stage):
+        for handler in stage.handlers:
+            stage.synchronizer.disconnect(handler)
+        stage.handlers = []
+
+    def _finish_stage(self, stage, state):
+        stage.state = state
+        stage.end = GLib.get_monotonic_time()
+        # Handlers of stopping stage tell us when it has stopped
+        if not stage.stopping:
+            self._disconnect(stage)
+        if stage.timeout_id is not None:
+            GLib.source_remove(stage.timeout_id)
+            stage.timeout_id = None
+        if state == StageState.FAILED:
+            logger.error('Synchronization stage {0} failed'
+                         .format(stage.name))
+        self.emit('stage-done', stage.name, state == StageState.DONE)
+
+    def on_stage_done(self, synchronizer, stage):
+        self._stage_stopped(stage, StageState.DONE)
+
+    def on_stage_failed(self, synchronizer, stage):
+        self._stage_stopped(stage, StageState.FAILED)
+
+    def _stage_stopped(self, stage, state):
+        if stage.stopping:
+            logger.debug('Timed out stage {0} stopped'.format(stage.name))
+            stage.stopping = False
+            self._disconnect(stage)
+        else:
+            self._finish_stage(stage, state)
+        self._schedule()
+
+    def on_stage_progress(self, synchronizer, gprop, stage):
+        if stage.state == StageState.RUNNING:
+            self._restart_timeout(stage)
+
+    def on_stage_timeout(self, stage):
+        stage.timeout_id = None
+        logger.warning('Stage {0} made no progress for {1}s, cancelling it'
+                       .format(stage.name, stage.timeout))
+        stage.stopping = True
+        self._finish_stage(stage, StageState.FAILED)
+        stage.synchronizer.cancel()
+        self._schedule()
+        return False
+
+
+class SyncCoordinator(GObject.Object):
+    """
+    Makes sure only one synchronization runs at a time. Synchronization is
+    built by calling `build`, which should return a Scheduler with all the
+    stages added.
+
+    Requests arriving while synchronization runs are merged into it, unless
+    they need data newer than the running one may fetch. In that case
+    exactly one follow-up synchronization is queued, no matter how many
+    such requests arrive.
+    """
+    __gsignals__ = {
+        'finished': (GObject.SignalFlags.RUN_LAST, None, [bool])
+    }
+    running = GObject.property(type=bool, default=False)
+    # Fraction of stages of running synchronization which are finished
+    progress = GObject.property(type=float, default=0)
+
+    def __init__(self, build, *args, **kwargs):
+        super(SyncCoordinator, self).__init__(*args, **kwargs)
+        self.build = build
+        self.scheduler = None
+        self.follow_up = False
+
+    def request(self, follow_up=False):
+        """ Starts synchronization, unless one is already running """
+        if self.scheduler is None:
+            self._start()
+        elif follow_up and not self.follow_up:
+            logger.debug('Queued follow-up synchronization')
+            self.follow_up = True
+        else:
+            logger.debug('Synchronization merged into the running one')
+
+    def cancel(self):
+        """ Cancels running synchronization and any follow-up """
+        self.follow_up = False
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+
+    def _start(self):
+        self.scheduler = self.build()
+        self.scheduler.connect('stage-done', self.on_stage_done)
+        self.scheduler.connect('finished', self.on_finished)
+        self.progress = 0
+        self.running = True
+        self.scheduler.run()
+
+    def on_stage_done(self, scheduler, stage, success):
+        done = sum(s.state not in (StageState.PENDING, StageState.RUNNING)
+                   for s in scheduler.stages.values())
+        self.progress = done / len(scheduler.stages)
+
+    def on_finished(self, scheduler, success):
+        self.scheduler = None
+        self.running = False
+        self.emit('finished', success)
+        if self.follow_up:
+            self.follow_up = False
+            self._start()
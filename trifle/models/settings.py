@@ -7,7 +7,8 @@ from trifle.utils import logger
 class Settings(Gio.Settings):
     types = {'notifications': 'boolean', 'start-refresh': 'boolean',
              'refresh-every': 'uint16', 'cache-items': 'int16',
-             'vertical-pos': 'uint16', 'horizontal-pos': 'uint16'}
+             'vertical-pos': 'uint16', 'horizontal-pos': 'uint16',
+             'parse-engine': 'string', 'items-model': 'string'}
 
     def __init__(self, *args, **kwargs):
         super(Settings, self).__init__(*args, **kwargs)
@@ -2,15 +2,19 @@ from gi.repository import Gtk
 from gi.repository import GdkPixbuf
 
 from trifle.utils import (SubscriptionType as SubType, sqlite, combine_ids,
-                          split_id, icon_pixbuf, SubscriptionColumn as Col)
+                          split_id, icon_pixbuf, SubscriptionColumn as Col,
+                          logger)
 
 
 class Subscriptions(Gtk.TreeStore):
 
     def __init__(self, *args, **kwargs):
-        # SubscriptionType, id for item, icon_fpath, name
-        super(Subscriptions, self).__init__(int, str, GdkPixbuf.Pixbuf, str)
+        # SubscriptionType, id for item, icon_fpath, name, number of unread
+        # and starred items
+        super(Subscriptions, self).__init__(int, str, GdkPixbuf.Pixbuf, str,
+                                            int, int)
         self.set_sort_column_id(Col.NAME, Gtk.SortType.ASCENDING)
+        self.members = None
 
     @property
     def labels(self):
@@ -33,7 +37,7 @@ class Subscriptions(Gtk.TreeStore):
                FROM subscriptions
                LEFT JOIN labels_fk ON labels_fk.item_id = subscriptions.id
                LEFT JOIN labels ON labels.id=labels_fk.label_id'''
-        sqlite.execute(q).connect('finished', self.on_update_data)
+        sqlite.select(q).connect('finished', self.on_update_data)
 
     def on_update_data(self, job, success):
         if not success:
@@ -76,6 +80,33 @@ class Subscriptions(Gtk.TreeStore):
             iter = self.append(labels_iter.get(split_id(combined_id)[0], None))
             self.set(iter, {Col.ID: combined_id, Col.ICON: icon_pixbuf(d[0]),
                             Col.TYPE: SubType.SUBSCRIPTION, Col.NAME: d[1]})
+        if self.members is not None:
+            self.on_counts_changed(self.members)
+
+    def count_items(self, members):
+        """ Keeps UNREAD and STARRED columns up to date with counts of
+        feeds.Memberships of items model """
+        self.members = members
+        members.connect('counts-changed', self.on_counts_changed)
+        self.on_counts_changed(members)
+
+    def on_counts_changed(self, members):
+        for row in self:
+            if row[Col.TYPE] == SubType.SUBSCRIPTION:
+                self.set_counts(row, members.count(split_id(row[Col.ID])[1]))
+                continue
+            # Items of label are items of its subscriptions
+            unread = starred = 0
+            for sub in row.iterchildren():
+                counts = members.count(split_id(sub[Col.ID])[1])
+                self.set_counts(sub, counts)
+                unread, starred = unread + counts[0], starred + counts[1]
+            self.set_counts(row, (unread, starred))
+
+    def set_counts(self, row, counts):
+        # Rows are not touched needlessly, views would redraw them
+        if (row[Col.UNREAD], row[Col.STARRED]) != counts:
+            row[Col.UNREAD], row[Col.STARRED] = counts
 
 #     def get_item_labels(self, itr):
 #         row = self[itr]
@@ -1,3 +1,4 @@
+from collections import deque
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
@@ -11,10 +12,11 @@ from trifle.models import settings
 from trifle.models import base
 from trifle.models import itemparse
 from trifle.utils import (logger, SubscriptionType, api_method, session,
-                          sqlite, StateIds, split_chunks, urlencode, quote,
-                          CONTENT_PATH, FAVICON_PATH, split_id, icon_name,
+                          sqlite, StateIds, urlencode, quote,
+                          contents, FAVICON_PATH, split_id, icon_name,
                           Message)
-from trifle.utils.async import JobExecutor
+from trifle.utils.async import WorkerPool
+from trifle.utils.sqlite import vacuum
 
 
 class Id(base.SyncObject):
@@ -23,6 +25,9 @@ class Id(base.SyncObject):
                          ('xt', 'user/-/state/com.google/read')],
               'starred': [('s', 'user/-/state/com.google/starred')]}
 
+    # Seconds between full synchronizations
+    full_sync_interval = 6 * 3600
+
     def __init__(self, *args, **kwargs):
         super(Id, self).__init__(*args, **kwargs)
         self.sync_status = {}
@@ -34,59 +39,121 @@ class Id(base.SyncObject):
             return False
         self.sync_status['synchronizing'] = True
 
-        item_limit = settings.settings['cache-items']
+        query = '''SELECT (SELECT MAX(update_time) FROM items),
+                          (SELECT value FROM sync_state
+                           WHERE key='full-sync')'''
+        sqlite.execute(query).connect('finished', self.on_sync_state)
+
+    def on_sync_state(self, job, success):
+        newest, last_full = job.result[0] if success else (None, None)
+        now = GLib.get_real_time()
+        # Only full synchronization finds items which became too old and
+        # flags changed by other clients on items we already have, so it
+        # still has to be done once in a while.
+        full = newest is None or last_full is None or \
+               now - last_full > self.full_sync_interval * 1E6
+        # refs maps item id to [update time, is unread, is starred] merged
+        # from all the states.
+        self.sync_status.update({'full': full, 'started': now, 'refs': {}})
+
+        getargs = [('n', settings.settings['cache-items'])]
+        if not full:
+            # Ask only for items changed since our newest one
+            getargs.append(('ot', int(newest // 1E6)))
+        logger.debug('{0} IDs synchronization'.format('Full' if full else
+                                                      'Incremental'))
         for name, state in self.states.items():
-            getargs = state + [('n', item_limit)]
-            url = api_method('stream/items/ids', getargs)
-            msg = self.auth.message('GET', url)
-            session.queue_message(msg, self.on_response, name)
-        # Initially mark everything as deletable and unflag all items.
-        # Laten in process items that are still important will be unmarked
-        # and reflagged again.
-        query = 'UPDATE items SET to_delete=1, unread=0, starred=0, to_sync=0'
-        sqlite.execute(query)
+            self.request(name, state + getargs)
+
+    def request(self, name, getargs):
+        url = api_method('stream/items/ids', getargs)
+        msg = self.auth.message('GET', url)
+        self.queue(msg, self.on_response, (name, getargs))
 
     def on_response(self, session, msg, data):
+        name, getargs = data
         status = msg.status_code
         if not 200 <= status < 400:
             logger.error('IDs synchronization failed: {0}'.format(status))
+            # Other states' responses may still arrive, fail only once
+            if self.sync_status.pop('refs', None) is not None:
+                GLib.idle_add(self.emit, 'sync-failed')
             return False
 
-        res = json.loads(msg.response_body.data)['itemRefs']
-        id_list = [(int(i['id']),) for i in res]
-        self.ensure_ids(id_list)
-        self.set_sync_flag({'update_time': int(i['timestampUsec']),
-                            'id': int(i['id'])} for i in res)
-        if data in ['unread', 'starred']:
-            self.set_flag(data, id_list)
+        if 'refs' not in self.sync_status:
+            # Synchronization has failed already
+            return
+        res = json.loads(msg.response_body.data)
+        refs = self.sync_status['refs']
+        for ref in res['itemRefs']:
+            item = refs.setdefault(int(ref['id']), [0, False, False])
+            item[0] = max(item[0], int(ref['timestampUsec']))
+            item[1] = item[1] or name == 'unread'
+            item[2] = item[2] or name == 'starred'
+
+        if 'continuation' in res and not self.sync_status['full']:
+            # Incremental synchronization must not miss anything changed,
+            # thus we follow continuations. Full one is limited by
+            # cache-items anyway.
+            getargs = [a for a in getargs if a[0] != 'c']
+            self.request(name, getargs + [('c', res['continuation'])])
+            return
 
-        self.sync_status[data] = True
+        self.sync_status[name] = True
         GLib.idle_add(self.notify, 'sync-status')
 
-    def ensure_ids(self, id_list):
-        # We'll insert any ids we don't yet have in our database
-        query = 'INSERT OR IGNORE INTO items(id) VALUES(?)'
-        sqlite.executemany(query, id_list)
-        # And set to_delete flag to zero for all ids we've got.
-        # This way all the items with to_delete flag set are too old.
-        query = 'UPDATE items SET to_delete=0 WHERE id=?'
-        sqlite.executemany(query, id_list)
-
-    def set_sync_flag(self, items):
-        query = '''UPDATE items SET to_sync=1, update_time=:update_time WHERE
-                   id=:id AND update_time<:update_time'''
-        sqlite.executemany(query, items)
-
-    def set_flag(self, flag, id_list):
-        query = 'UPDATE items SET {0}=1 WHERE id=?'.format(flag)
-        sqlite.executemany(query, id_list)
-
     @staticmethod
     def on_status_change(self, gprop):
         if all(self.sync_status.get(key, False) for key in self.states.keys()):
+            # Every finished state notifies, only the first one completes
+            refs = self.sync_status.pop('refs', None)
+            if refs is None:
+                return
             logger.debug('IDs synchronizaton completed')
-            sqlite.commit()
-            GLib.idle_add(self.emit, 'sync-done')
+            refs = [(i,) + tuple(v) for i, v in refs.items()]
+            full = self.sync_status['started'] if self.sync_status['full'] \
+                   else None
+            sqlite.call(_reconcile_ids, refs, full)
+            sqlite.commit().connect('finished',
+                                    lambda *x: self.emit('sync-done'))
+
+
+def _reconcile_ids(cnn, refs, full):
+    """ Applies (id, update_time, unread, starred) item references received
+    from server. full should be the time synchronization started at, if it was
+    a full one. Executed in SQLite thread """
+    cnn.execute('''CREATE TEMP TABLE IF NOT EXISTS synced_ids
+                   (id INTEGER PRIMARY KEY, update_time UNSIGNED BIG INT,
+                    unread BOOLEAN, starred BOOLEAN)''')
+    cnn.execute('DELETE FROM synced_ids')
+    cnn.executemany('INSERT INTO synced_ids VALUES(?, ?, ?, ?)', refs)
+
+    # We'll insert any ids we don't yet have in our database and mark items
+    # which were updated since we've fetched them.
+    cnn.execute('INSERT OR IGNORE INTO items(id) SELECT id FROM synced_ids')
+    cnn.execute('''UPDATE items SET to_sync=1, update_time=(SELECT update_time
+                   FROM synced_ids AS S WHERE S.id=items.id)
+                   WHERE id IN (SELECT id FROM synced_ids) AND update_time <
+                   (SELECT update_time FROM synced_ids AS S
+                    WHERE S.id=items.id)''')
+    if full is not None:
+        # Server gave us all the items worth keeping, others are too old.
+        # Flags of items we didn't get are not set anymore.
+        cnn.execute('''UPDATE items SET to_delete=1 WHERE to_delete=0 AND
+                       id NOT IN (SELECT id FROM synced_ids)''')
+        cnn.execute('''UPDATE items SET to_delete=0 WHERE to_delete=1 AND
+                       id IN (SELECT id FROM synced_ids)''')
+        for flag in ('unread', 'starred'):
+            cnn.execute('''UPDATE items SET {0}=0 WHERE {0}=1 AND id NOT IN
+                           (SELECT id FROM synced_ids WHERE {0})'''
+                        .format(flag))
+        query = '''INSERT OR REPLACE INTO sync_state(key, value)
+                   VALUES ('full-sync', ?)'''
+        cnn.execute(query, (full,))
+    for flag in ('unread', 'starred'):
+        cnn.execute('''UPDATE items SET {0}=1 WHERE id IN
+                       (SELECT id FROM synced_ids WHERE {0}) AND {0}=0'''
+                    .format(flag))
 
 
 class Flags(base.SyncObject):
@@ -103,31 +170,31 @@ class Flags(base.SyncObject):
 
         for flag, st in itertools.product(StateIds, [True, False]):
             self.sync_status += 1
+            # Flags just set by user might not be commited yet, thus they're
+            # read by the writer rather than by a reader.
             sqlite.execute(query, (flag, st)).connect('finished', self.on_data,
                                                       (flag, st))
 
     def on_data(self, job, success, data):
         flag, st = data
         self.sync_status -= 1
+        rows = job.result if success else []
         if not success:
             logger.error('Could not get data from SQLite correctly')
-            return
 
-        if not len(job.result) == 0:
-            uri = api_method('edit-tag')
-            req_type = 'application/x-www-form-urlencoded'
-
-            post = (('r' if st else 'a', flag,), ('T', self.auth.edit_token),)
-            chunks = split_chunks(job.result, 250, None)
-            for chunk in chunks:
-                iids, ids = zip(*filter(lambda x: x is not None, chunk))
-                iids = tuple(zip(itertools.repeat('i'), iids))
-                payload = urlencode(iids + post)
-                msg = self.auth.message('POST', uri)
-                msg.set_request(req_type, Soup.MemoryUse.COPY, payload,
-                                len(payload))
-                session.queue_message(msg, self.on_response, ids)
-                self.sync_status += 1
+        uri = api_method('edit-tag')
+        req_type = 'application/x-www-form-urlencoded'
+        post = (('r' if st else 'a', flag,), ('T', self.auth.edit_token),)
+        # Server accepts up to 250 items per request
+        for start in range(0, len(rows), 250):
+            iids, ids = zip(*rows[start:start + 250])
+            iids = tuple(zip(itertools.repeat('i'), iids))
+            payload = urlencode(iids + post)
+            msg = self.auth.message('POST', uri)
+            msg.set_request(req_type, Soup.MemoryUse.COPY, payload,
+                            len(payload))
+            self.queue(msg, self.on_response, ids)
+            self.sync_status += 1
 
         if self.sync_status == 0:
             # In case we didn't have any flags to synchronize
@@ -151,10 +218,58 @@ class Flags(base.SyncObject):
             sqlite.commit()
 
 
+class FetchController(object):
+    """
+    Tunes size of item chunks and amount of chunks requested at once from
+    observed responses. Both grow additively while responses are quick and
+    small enough and are halved on errors, slow or huge responses (AIMD).
+    """
+    # Asking for more than 250 items at once gets exactly 250 items
+    max_chunk, min_chunk, chunk_step = 250, 25, 25
+    # Session won't run more requests to one host at once anyway
+    max_window = 8
+    # Responses slower or bigger than these are considered overloading
+    target_latency = 5.0
+    target_size = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.chunk_size = 100
+        self.window = 2
+
+    def success(self, latency, size):
+        if latency > self.target_latency or size > self.target_size:
+            self.decrease()
+        else:
+            self.chunk_size = min(self.max_chunk,
+                                  self.chunk_size + self.chunk_step)
+            self.window = min(self.max_window, self.window + 1)
+
+    def failure(self):
+        self.decrease()
+
+    def decrease(self):
+        self.chunk_size = max(self.min_chunk, self.chunk_size // 2)
+        self.window = max(1, self.window // 2)
+
+
 class Items(base.SyncObject):
+    # Shared by all synchronizations, so what was learned is not lost
+    controller = FetchController()
+    # WorkerPool items are parsed in. Pool owned by Application should be
+    # used, so workers don't need to be started for every synchronization.
+    executor = GObject.property(type=object)
+
     def __init__(self, *args, **kwargs):
         super(Items, self).__init__(*args, **kwargs)
+        # Amount of chunks being fetched or parsed
         self.sync_status = 0
+        # Amount of chunks requested and of those which failed after all the
+        # retries
+        self.chunks = self.failed_chunks = 0
+        self.in_flight = 0
+        self.pending = deque()
+        # Hashes of contents we already have, by item id
+        self.hashes = {}
 
     def sync(self):
         if self.sync_status > 0:
@@ -162,14 +277,16 @@ class Items(base.SyncObject):
             return
         self.sync_status = 0
         logger.debug('Synchronizing items')
-        self.dump_garbage()
 
-        job = sqlite.execute('SELECT id FROM items WHERE to_sync=1')
-        job.connect('finished', self.on_sync_ids)
+        # Items about to be collected as garbage are not worth fetching
+        query = '''SELECT id, content_hash FROM items
+                   WHERE to_sync=1 AND to_delete=0'''
+        sqlite.execute(query).connect('finished', self.on_sync_ids)
 
     def on_sync_ids(self, job, success):
         if not success:
             logger.error('Could not get data from SQLite')
+            GLib.idle_add(self.emit, 'sync-failed')
             return
 
         if len(job.result) == 0:
@@ -177,69 +294,216 @@ class Items(base.SyncObject):
             GLib.idle_add(self.emit, 'sync-done')
             return
 
-        # Somewhy when streaming items and asking more than 512 returns 400.
-        # Asking anything in between 250 and 512 returns exactly 250 items.
-        chunks = split_chunks((('i', i) for i, in job.result), 250, ('', ''))
-        # Asynchronous job queue for items parsing
-        # We will, unless we have a bug, have only one synchronization at time
-        # thus it is safe to initialize it like that.
-        executor = JobExecutor()
-        executor.start()
+        self.pending.extend(i for i, h in job.result)
+        self.hashes = {i: h for i, h in job.result if h is not None}
+        if self.executor is None:
+            self.executor = WorkerPool(itemparse.warm)
+        self.connect('notify::sync-status', self.on_sync_status)
+        self.request_chunks()
 
+    def request_chunks(self):
+        """ Requests as many chunks as controller allows to be in flight """
         uri = api_method('stream/items/contents')
         req_type = 'application/x-www-form-urlencoded'
-        for chunk in chunks:
-            self.sync_status += 1
-            data = urlencode(chunk)
+        while self.pending and self.in_flight < self.controller.window:
+            size = min(self.controller.chunk_size, len(self.pending))
+            ids = [self.pending.popleft() for _ in range(size)]
+            data = urlencode([('i', i) for i in ids])
             message = self.auth.message('POST', uri)
             message.set_request(req_type, Soup.MemoryUse.COPY, data,
                                 len(data))
-            session.queue_message(message, self.on_response, executor)
-        self.connect('notify::sync-status', self.on_sync_status, executor)
+            sent = GLib.get_monotonic_time()
+            self.queue(message, self.on_response, (sent, ids))
+            self.in_flight += 1
+            self.chunks += 1
+            self.sync_status += 1
 
-    def on_response(self, session, message, executor):
+    def on_response(self, session, message, data):
+        sent, ids = data
+        self.in_flight -= 1
         status = message.status_code
+        if status == Soup.Status.CANCELLED:
+            # Server didn't fail, chunk is left for the next synchronization
+            self.chunks -= 1
+            self.sync_status -= 1
+            return
         if not 200 <= status < 400:
             logger.error('Items synchronization failed {0}'.format(status))
+            self.controller.failure()
+            self.request_chunks()
+            # Items of this chunk stay marked with to_sync and will be
+            # fetched during next synchronization
+            self.failed_chunks += 1
+            self.sync_status -= 1
             return
 
-        job = executor.submit(itemparse.process_items,
-                              message.response_body.data)
-        job.connect('finished', self.on_chunk_parsed, executor)
-
-    def on_chunk_parsed(self, job, success, executor):
-        self.sync_status -= 1
+        latency = (GLib.get_monotonic_time() - sent) / 1E6
+        self.controller.success(latency, message.response_body.length)
+        self.request_chunks()
+        # Contents of items with these hashes won't be processed again
+        hashes = {i: self.hashes[i] for i in ids if i in self.hashes}
+        # Bytes are handed to the worker as they are, it decodes them
+        job = self.executor.submit(itemparse.process_items,
+                                   message.response_body.flatten().get_data(),
+                                   hashes)
+        job.connect('finished', self.on_chunk_parsed)
+
+    def on_chunk_parsed(self, job, success):
         if not success:
+            self.failed_chunks += 1
             try:
                 raise job.exception
             except:
                 logger.exception('Failed to parse item chunk')
         else:
+            # Items with unchanged content come without summary and text
+            changed = [item for item in job.result if 'summary' in item]
+            unchanged = [item for item in job.result if 'summary' not in item]
             query = '''UPDATE items SET title=:title, author=:author,
                        summary=:summary, href=:href, time=:time,
-                       subscription=:subscription WHERE id=:id'''
-            sqlite.executemany(query, job.result)
+                       subscription=:subscription, content_hash=:content_hash,
+                       to_sync=0 WHERE id=:id'''
+            sqlite.executemany(query, changed)
+            query = 'DELETE FROM items_search WHERE rowid=:id'
+            sqlite.executemany(query, changed)
+            query = '''INSERT INTO items_search(rowid, title, author, summary,
+                       content) VALUES(:id, :title, :author, :summary, :text)'''
+            sqlite.executemany(query, changed)
+            if unchanged:
+                query = '''UPDATE items SET title=:title, author=:author,
+                           href=:href, time=:time, subscription=:subscription,
+                           to_sync=0 WHERE id=:id'''
+                sqlite.executemany(query, unchanged)
+                query = '''UPDATE items_search SET title=:title,
+                           author=:author WHERE rowid=:id'''
+                sqlite.executemany(query, unchanged)
+        self.sync_status -= 1
+
+    def cancel(self):
+        # Chunks not requested yet are left for the next synchronization
+        self.pending.clear()
+        super(Items, self).cancel()
 
     @staticmethod
-    def on_sync_status(self, gprop, executor):
-        if self.sync_status != 0:
+    def on_sync_status(self, gprop):
+        if self.sync_status != 0 or self.pending:
             return
-        sqlite.commit()
-        executor.stop()
-        GLib.idle_add(self.emit, 'sync-done')
-        logger.debug('Items synchronization completed')
+        # Whatever we got is worth keeping, even if some chunks failed
+        signal = 'sync-done' if self.failed_chunks < self.chunks else \
+                 'sync-failed'
+        # Models read from the database via sqlite.select, which will see our
+        # changes only after they are commited.
+        sqlite.commit().connect('finished', lambda *x: self.emit(signal))
+        if self.failed_chunks:
+            logger.warning('Items synchronization completed, {0} of {1} '
+                           'chunks failed'.format(self.failed_chunks,
+                                                  self.chunks))
+        else:
+            logger.debug('Items synchronization completed')
+
+
+def _collect_items(cnn, limit):
+    """ Deletes up to limit items marked with to_delete flag, returns their
+    ids. Executed in SQLite thread """
+    query = 'SELECT id FROM items WHERE to_delete=1 LIMIT ?'
+    ids = cnn.execute(query, (limit,)).fetchall()
+    cnn.executemany('DELETE FROM items WHERE id=?', ids)
+    cnn.executemany('DELETE FROM items_search WHERE rowid=?', ids)
+    return ids
+
+
+def _collect_contents(cnn, ids):
+    """ Deletes contents of items, returns amount of bytes taken by bodies
+    which are not referred to anymore. Executed in contents' SQLite thread """
+    query = '''SELECT refs, LENGTH(CAST(data AS BLOB)) FROM bodies
+               WHERE hash=(SELECT hash FROM item_bodies WHERE id=?)'''
+    size = 0
+    for item_id in ids:
+        body = cnn.execute(query, item_id).fetchone()
+        if body is not None and body[0] <= 1:
+            size += body[1]
+        # Triggers will delete body if this is the last reference
+        cnn.execute('DELETE FROM item_bodies WHERE id=?', item_id)
+    return size
+
+
+class Garbage(base.SyncObject):
+    """
+    Removes items marked with to_delete flag and their contents. Work is
+    done in SQLite threads in chunks of chunk_size items, so other queries
+    can be executed in between.
+    """
+    chunk_size = 500
+
+    def sync(self):
+        # Amount of deleted items, size of their contents, amount of bytes
+        # given back to filesystem and amount of jobs we're waiting for.
+        self.sync_status = {'items': 0, 'bytes': 0, 'freed': 0, 'pending': 1}
+        job = sqlite.call(_collect_items, self.chunk_size)
+        job.connect('finished', self.on_items_collected)
+
+    def on_items_collected(self, job, success):
+        if not success:
+            logger.error('Could not delete expired items')
+            self.done()
+        elif len(job.result) == 0:
+            # Nothing left to delete, give space back to filesystem
+            for database in (sqlite, contents):
+                job = database.call(vacuum)
+                job.connect('finished', self.on_vacuumed)
+                self.sync_status['pending'] += 1
+            self.done()
+        else:
+            self.sync_status['items'] += len(job.result)
+            job = contents.call(_collect_contents, job.result)
+            job.connect('finished', self.on_contents_collected)
+            self.sync_status['pending'] += 1
+            # Continue with the next chunk
+            job = sqlite.call(_collect_items, self.chunk_size)
+            job.connect('finished', self.on_items_collected)
+
+    def on_contents_collected(self, job, success):
+        if success:
+            self.sync_status['bytes'] += job.result
+        else:
+            logger.error('Could not delete contents of expired items')
+        self.done()
+
+    def on_vacuumed(self, job, success):
+        if success:
+            self.sync_status['freed'] += job.result
+        self.done()
+
+    def done(self):
+        self.sync_status['pending'] -= 1
+        self.notify('sync-status')
+        if self.sync_status['pending'] == 0:
+            logger.debug('Collected {items} items ({bytes} bytes of content), '
+                         '{freed} bytes freed'.format(**self.sync_status))
+            GLib.idle_add(self.emit, 'sync-done')
 
-    def dump_garbage(self):
-        """ Remove all items (and contents) marked with to_delete flag """
-        query = 'SELECT id FROM items WHERE to_delete=1'
 
-        def callback(job, success):
-            for item_id, in job.result:
-                fpath = os.path.join(CONTENT_PATH, str(item_id))
-                if os.path.isfile(fpath):
-                    os.remove(fpath)
-        sqlite.execute(query).connect('finished', callback)
-        sqlite.execute('DELETE FROM items WHERE to_delete=1')
+def _update_subscriptions(cnn, subscriptions, labels, labels_fk):
+    """ Makes subscriptions, labels and labels_fk tables contain given rows,
+    touching only rows which differ, so items of subscriptions which didn't
+    change are not considered changed. Executed in SQLite thread """
+    tables = (('subscriptions', ('id', 'url', 'title'), subscriptions),
+              ('labels', ('id', 'name'), labels))
+    for table, columns, rows in tables:
+        query = 'SELECT {0} FROM {1}'.format(', '.join(columns), table)
+        current = {row[0]: row[1:] for row in cnn.execute(query)}
+        query = 'DELETE FROM {0} WHERE id=?'.format(table)
+        cnn.executemany(query, ((i,) for i in current.keys() - rows.keys()))
+        query = 'INSERT OR REPLACE INTO {0}({1}) VALUES ({2})'.format(
+                table, ', '.join(columns), ', '.join('?' * len(columns)))
+        cnn.executemany(query, ((i,) + row for i, row in rows.items()
+                                if current.get(i) != row))
+
+    current = set(cnn.execute('SELECT item_id, label_id FROM labels_fk'))
+    query = 'DELETE FROM labels_fk WHERE item_id=? AND label_id=?'
+    cnn.executemany(query, current - labels_fk)
+    query = 'INSERT INTO labels_fk(item_id, label_id) VALUES(?, ?)'
+    cnn.executemany(query, labels_fk - current)
 
 
 class Subscriptions(base.SyncObject):
@@ -251,40 +515,25 @@ class Subscriptions(base.SyncObject):
     def sync(self):
         url = api_method('subscription/list')
         msg = self.auth.message('GET', url)
-        session.queue_message(msg, self.on_response, None)
+        self.queue(msg, self.on_response)
 
     def on_response(self, session, msg, data):
         status = msg.status_code
         if not 200 <= status < 400:
             logger.error('Subscriptions synchronization failed {0}'
                          .format(status))
+            GLib.idle_add(self.emit, 'sync-failed')
             return
 
-        # Clear database, it's easier than updating everything ;)
-        q = '; DELETE FROM '.join(('subscriptions', 'labels', 'labels_fk'))
-        sqlite.executescript('DELETE FROM ' + q)
         res = json.loads(msg.response_body.data)['subscriptions']
-        # Some items do not have htmlUrl
-        for d in res:
-            d.setdefault('htmlUrl')
-
-        # Reinsert items
-        q = '''INSERT INTO subscriptions(id, url, title)
-               VALUES(:id, :htmlUrl, :title)'''
-        sqlite.executemany(q, res)
-
         lid = lambda x: x['id'].split('/', 2)[-1]
-        # Reinsert labels
-        q = 'INSERT OR IGNORE INTO labels(id, name) VALUES (?, ?)'
-        values = {(lid(l), l['label']) for s in res for l in s['categories']}
-        sqlite.executemany(q, values)
-
-        # Estabilish foreign keys via labels_fk
-        q = 'INSERT INTO labels_fk(item_id, label_id) VALUES(?, ?)'
-        values = ((s['id'], lid(l)) for s in res for l in s['categories'])
-        sqlite.executemany(q, values)
+        # Some items do not have htmlUrl
+        subscriptions = {s['id']: (s.get('htmlUrl'), s['title']) for s in res}
+        labels = {lid(l): (l['label'],) for s in res for l in s['categories']}
+        labels_fk = {(s['id'], lid(l)) for s in res for l in s['categories']}
+        sqlite.call(_update_subscriptions, subscriptions, labels, labels_fk)
         logger.debug('Subscriptions synchronization completed')
-        GLib.idle_add(self.emit, 'sync-done')
+        sqlite.commit().connect('finished', lambda *x: self.emit('sync-done'))
 
     def subscribe_to(self, url):
         uri = api_method('subscription/quickadd')
@@ -333,7 +582,7 @@ class Favicons(base.SyncObject):
 
     def sync(self):
         query = 'SELECT url FROM subscriptions'
-        sqlite.execute(query).connect('finished', self.on_site_uris)
+        sqlite.select(query).connect('finished', self.on_site_uris)
 
     def on_site_uris(self, job, success):
         uri = 'https://getfavicon.appspot.com/{0}?defaulticon=none'
@@ -345,7 +594,7 @@ class Favicons(base.SyncObject):
                 # or becomes available
                continue
             msg = Message('GET', uri.format(quote(site_uri)))
-            session.queue_message(msg, self.on_response, site_uri)
+            self.queue(msg, self.on_response, site_uri)
             self.sync_status += 1
         if self.sync_status == 0:
             logger.debug('Favicons synchronization completed')
@@ -353,15 +602,23 @@ class Favicons(base.SyncObject):
 
     def on_response(self, session, msg, site_uri):
         self.sync_status -= 1
+        # Cancelled requests and transport errors (below 100) tell nothing
+        # about the icon, so it will be asked for again
+        if msg.status_code < 100:
+            logger.warning('Could not get icon for {0}'.format(site_uri))
+        else:
+            self.save_icon(msg, site_uri)
+        if self.sync_status == 0:
+            logger.debug('Favicons synchronization completed')
+            GLib.idle_add(self.emit, 'sync-done')
+
+    def save_icon(self, msg, site_uri):
         with open(icon_name(site_uri), 'wb') as f:
             if not (200 <= msg.status_code < 400) or msg.status_code == 204:
                 logger.warning('Could not get icon for {0}'.format(site_uri))
                 # Save an empty file so we know that we don't have an icon
             else:
                 f.write(msg.response_body.flatten().get_data())
-        if self.sync_status == 0:
-            logger.debug('Favicons synchronization completed')
-            GLib.idle_add(self.emit, 'sync-done')
 
     def has_icon(self, site_uri):
         return os.path.isfile(icon_name(site_uri))
@@ -0,0 +1,156 @@
+"""
+Measures per-item cost of item processing.
+
+    python3 -m trifle.tests.benchmark_itemparse [response.json ...]
+
+Saved responses of stream/items/contents make the most realistic corpus.
+Made up items from itemparse.sample are used if no files are given.
+"""
+import lxml.html
+import lxml.html.clean
+import sys
+import time
+
+from trifle.models import itemparse
+
+
+# process_item as it was before Sanitizer, verbatim, for comparison
+def legacy_process_item(item):
+    """
+    Should return a (dictionary, content,) pair.
+    Dictionary should contain subscription, time, href, author, title and
+    summary fields.
+    If any of values doesn't exist, they'll be replaced with meaningful
+    defaults. For example "Unknown" for author or "Untitled item" for
+    title
+    """
+    # After a lot of fiddling around I realized one thing. We are IN NO
+    # WAY guaranteed that any of these fields exists at all.
+    # This idiocy should make this method bigger than a manpage for
+    # understanding teenage girls' thought processes.
+    content = item['content']['content'] if 'content' in item else \
+              item['summary']['content'] if 'summary' in item else ''
+
+    fragments = lxml.html.fragments_fromstring(content)
+    main = lxml.html.HtmlElement()
+    main.tag = 'div'
+    # Put fragments all under one element for easier manipulation
+    if len(fragments) > 0 and isinstance(fragments[0], str):
+        main.text = fragments[0]
+        del fragments[0]
+    for key, fragment in enumerate(fragments):
+        if isinstance(fragment, lxml.html.HtmlElement):
+            main.append(fragment)
+        else:
+            main[-1].tail = fragment
+
+    # Get summary text before all the modifications.
+    summary = main.text_content().replace('\n', ' ').strip()[:250]
+
+    # Replace all iframes with regular link
+    for iframe in main.xpath('//iframe'):
+        src = iframe.get('src')
+        if not src:
+            iframe.getparent().remove(iframe)
+        else:
+            link = lxml.html.HtmlElement(src, attrib = {
+                                                    'href': src,
+                                                    'class':'trifle_iframe'})
+            link.tag = 'a'
+            iframe.getparent().replace(iframe, link)
+
+    # Remove following attributes from elements
+    remove = ('width', 'height', 'color', 'size', 'align', 'background',
+              'bgcolor', 'border', 'cellpadding', 'cellspacing',)
+    xpath = '//*[{0}]'.format(' or '.join('@'+a for a in remove))
+    for el in main.xpath(xpath):
+        attrib = el.attrib
+        for attr in remove:
+            if attr in attrib:
+                attrib.pop(attr)
+
+    # Re-level headers. Make sure highest header level is h1 and they decrease
+    # by steps of one.
+    all_header_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+    # //h1|//h2|//h3|//h4...
+    used_headers = main.xpath('|'.join('//' + tag for tag in all_header_tags))
+    used_header_tags = {header.tag for header in used_headers}
+    header_tag_mapping = dict(zip(sorted(used_header_tags), all_header_tags))
+    for header in used_headers:
+        header.tag = header_tag_mapping[header.tag]
+
+
+    content = lxml.html.tostring(main, encoding='unicode')
+    cleaner = lxml.html.clean.Cleaner()
+    cleaner.remove_tags = ['font']
+    content = cleaner.clean_html(content)
+
+    time = int(item['timestampUsec'])
+    if time >= int(item.get('updated', -1)) * 1E6:
+        time = item['updated'] * 1E6
+    try:
+        href = item['alternate'][0]['href']
+    except KeyError:
+        href = item['origin']['htmlUrl']
+
+    title = item.get('title', None)
+    if title is not None:
+        title = lxml.html.fromstring(title).text_content().replace('\n', ' ')
+        title = title.strip()
+
+    return {'title': title, 'summary': summary, 'href': href,
+            'author': item.get('author', None), 'time': time,
+            'subscription': item['origin']['streamId']}, content
+
+
+def contents(items):
+    for item in items:
+        yield item['content']['content'] if 'content' in item else \
+              item['summary']['content'] if 'summary' in item else ''
+
+
+def differs(item):
+    """ Whether title, summary or content of item differ from the legacy
+    ones """
+    legacy, legacy_content = legacy_process_item(item)
+    metadata, content = itemparse.process_item(item)
+    return (legacy['title'], legacy['summary'], legacy_content) != \
+           (metadata['title'], metadata['summary'], content)
+
+
+def measure(fn, items, repeat=5):
+    """ Returns the best of `repeat` runs in seconds per item """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        took = (time.perf_counter() - start) / len(items)
+        best = took if best is None else min(best, took)
+    return best
+
+
+def main(paths):
+    if paths:
+        items = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                items.extend(itemparse.iter_array(f.read(), 'items'))
+    else:
+        items = list(itemparse.iter_array(itemparse.sample(200), 'items'))
+    size = sum(len(content) for content in contents(items)) / len(items)
+    print('{0} items, {1:.0f} characters of content on average'.format(
+          len(items), size))
+
+    differ = sum(differs(item) for item in items)
+    if differ:
+        print('Output differs for {0} items'.format(differ))
+
+    legacy = measure(legacy_process_item, items)
+    current = measure(itemparse.process_item, items)
+    print('legacy       {0:8.1f} us/item'.format(legacy * 1E6))
+    print('process_item {0:8.1f} us/item ({1:.2f}x)'.format(
+          current * 1E6, legacy / current))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,8 +2,10 @@ from concurrent import futures
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
-from threading import Thread, Lock, current_thread
+from threading import Thread, Lock, Semaphore, current_thread, local
 from queue import Queue
+import logging
+import multiprocessing
 """
 A module for easy combination of MainLoop and off-MainThread processing.
 
@@ -24,6 +26,8 @@ Usage example:
 Don't forget to call `GLib.threads_init()`
 """
 
+logger = logging.getLogger('trifle')
+
 
 class Job(GObject.Object):
     __gsignals__ = {
@@ -32,6 +36,32 @@ class Job(GObject.Object):
     result = GObject.property(type=object, default=None)
 
 
+class PagedJob(Job):
+    """
+    Job which delivers its result in pages via 'rows' signal instead of
+    `result` property. 'finished' is emitted after the last page.
+    """
+    __gsignals__ = {
+        'rows': (GObject.SignalFlags.RUN_LAST, None, [object])
+    }
+    # How many pages may wait for MainLoop before producer is blocked
+    backlog = 2
+
+    def __init__(self, *args, **kwargs):
+        super(PagedJob, self).__init__(*args, **kwargs)
+        self._pending = Semaphore(self.backlog)
+
+    def add_rows(self, rows):
+        """ Should be called by producer (not from MainThread!) """
+        self._pending.acquire()
+        GLib.idle_add(self._emit_rows, rows)
+
+    def _emit_rows(self, rows):
+        self.emit('rows', rows)
+        self._pending.release()
+        return False
+
+
 class ExecutorJob(Job):
     future = GObject.property(type=object)
 
@@ -88,3 +118,140 @@ class JobExecutor(Thread):
         before call of this function.
         """
         self._jobs.put((None, None, None, None,))
+
+
+def _noop():
+    pass
+
+
+# Initializers which have run in the current worker
+_worker = local()
+
+
+def _run(initializer, fn, args, kwargs):
+    """ Runs fn in worker, running initializer first if this worker has
+    not run it yet """
+    if initializer is not None:
+        if not hasattr(_worker, 'initialized'):
+            _worker.initialized = set()
+        if initializer not in _worker.initialized:
+            initializer()
+            _worker.initialized.add(initializer)
+    return fn(*args, **kwargs)
+
+
+class WorkerPool(object):
+    """
+    Long living pool of workers, meant to be owned by Application and shared
+    by all synchronizations. Workers run `initializer` before their first
+    job, are started as backlog grows up to `max_workers` and all of them are
+    retired after pool is idle for `idle_timeout` seconds.
+
+    Workers are either processes or threads, depending on `engine`. Threads
+    avoid pickling arguments and results and starting processes, but are
+    only worth it if work mostly runs without holding GIL.
+
+    Has the same submit interface as JobExecutor, but needs no starting
+    and stopping. Must be used from MainThread.
+    """
+    engines = {'process': futures.ProcessPoolExecutor,
+               'thread': futures.ThreadPoolExecutor}
+
+    def __init__(self, initializer=None, max_workers=None, idle_timeout=300,
+                 engine='process'):
+        self.initializer = initializer
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.idle_timeout = idle_timeout
+        self._engine = engine
+        self._executor = None
+        self._pending = 0
+        self._retire_source = None
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        if engine not in self.engines:
+            raise ValueError('Unknown engine {0}'.format(engine))
+        if engine != self._engine:
+            # Work already submitted is completed by the old workers
+            self.shutdown(wait=False)
+            self._engine = engine
+
+    def submit(self, fn, *args, **kwargs):
+        if self._retire_source is not None:
+            GLib.source_remove(self._retire_source)
+            self._retire_source = None
+        if self._executor is None:
+            executor = self.engines[self._engine]
+            self._executor = executor(self.max_workers)
+        job = ExecutorJob()
+        job.connect('finished', self._on_finished)
+        self._pending += 1
+        job.future = self._executor.submit(_run, self.initializer, fn, args,
+                                           kwargs)
+        return job
+
+    def warm(self, workers=1):
+        """ Starts workers before they are needed """
+        for _ in range(min(workers, self.max_workers)):
+            self.submit(_noop)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _on_finished(self, job, success):
+        self._pending -= 1
+        if self._pending == 0 and self._retire_source is None:
+            self._retire_source = GLib.timeout_add_seconds(self.idle_timeout,
+                                                           self._retire)
+
+    def _retire(self):
+        self._retire_source = None
+        if self._pending == 0:
+            logger.debug('Retiring idle workers')
+            self.shutdown(wait=False)
+        return False
+
+
+def benchmark(fn, args, callback, engines=('process', 'thread'), jobs=4,
+              **kwargs):
+    """
+    Measures how long each of WorkerPool engines takes to complete `jobs`
+    calls of fn(*args) with warm workers. Calls callback with dictionary of
+    engine names and seconds. kwargs are passed to WorkerPool.
+    """
+    results = {}
+    engines = list(engines)
+
+    def run_next():
+        pool = WorkerPool(engine=engines[0], **kwargs)
+        pool.warm(pool.max_workers)
+        # Workers are warm once _noop jobs are done, measure after that
+        GLib.timeout_add(50, measure, pool)
+
+    def measure(pool):
+        if pool._pending > 0:
+            return True
+        started = GLib.get_monotonic_time()
+        remaining = [jobs]
+
+        def on_finished(job, success):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                engine = engines.pop(0)
+                results[engine] = (GLib.get_monotonic_time() - started) / 1E6
+                pool.shutdown(wait=False)
+                if engines:
+                    run_next()
+                else:
+                    callback(results)
+
+        for _ in range(jobs):
+            pool.submit(fn, *args).connect('finished', on_finished)
+        return False
+    run_next()
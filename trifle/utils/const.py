@@ -8,16 +8,18 @@ VERSION = '.'.join(str(part) for part in VERSION_INFO)
 # http://standards.freedesktop.org/basedir-spec/basedir-spec-latest.html
 CACHE_PATH = os.path.join(GLib.get_user_cache_dir(), 'trifle')
 MODULE_PATH = os.path.dirname(os.path.abspath(sys.argv[0]))
-CONTENT_PATH = os.path.join(CACHE_PATH, 'content')
+CONTENT_PATH = os.path.join(CACHE_PATH, 'contents')
+# Earlier versions stored contents here, one file per item
+LEGACY_CONTENT_PATH = os.path.join(CACHE_PATH, 'content')
 FAVICON_PATH = os.path.join(CACHE_PATH, 'favicons')
 
 SubscriptionType = namedtuple('SubscriptionType', 'LABEL SUBSCRIPTION')(0, 1)
 
 SubscriptionColumn = namedtuple('SubscriptionColumn',
-                                'TYPE ID ICON NAME')(*range(4))
+                                'TYPE ID ICON NAME UNREAD STARRED')(*range(6))
 
 ItemsColumn = namedtuple('ItemsColumn', 'ID TITLE SUMMARY LINK TIMESTAMP '\
-                         'UNREAD STARRED SUB_URI SUB_TITLE SUB_ID LBL_ID '\
+                         'UNREAD STARRED SUB_URI SUB_TITLE SUB_ID VISIBLE '\
                          'FORCE_VISIBLE')(*range(12))
 
 StateIds = namedtuple('Flags', 'READ KEPT_UNREAD STARRED')(
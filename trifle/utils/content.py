@@ -0,0 +1,107 @@
+"""
+Item contents are kept in a separate SQLite database. Parsing workers write
+into it directly with `store`, everything in MainThread should go through
+`contents` thread.
+
+Bodies are stored once per distinct content and items refer to them by
+hash (see data/migrations/content/02-bodies.sql).
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger('trifle')
+
+from trifle.utils import const
+from trifle.utils.sqlite import SQLite, script, incremental_vacuum
+
+
+def import_files(cnn):
+    """ Migrates contents stored as files by earlier versions """
+    path = const.LEGACY_CONTENT_PATH
+    if not os.path.isdir(path):
+        return
+
+    # Files we could not read are left alone
+    imported = []
+
+    def read_files(names):
+        for name in names:
+            try:
+                with open(os.path.join(path, name), 'r') as f:
+                    content = int(name), f.read()
+            except (ValueError, OSError, UnicodeDecodeError):
+                logger.warning('Could not import content {0}'.format(name))
+                continue
+            imported.append(name)
+            yield content
+
+    names = os.listdir(path)
+    # Newer contents might be stored already, don't replace them
+    query = 'INSERT OR IGNORE INTO content(id, data) VALUES(?, ?)'
+    cnn.executemany(query, read_files(names))
+    cnn.commit()
+    for name in imported:
+        os.remove(os.path.join(path, name))
+    if len(imported) == len(names):
+        os.rmdir(path)
+    logger.debug('Imported {0} of {1} content files'.format(len(imported),
+                                                           len(names)))
+
+
+_local = threading.local()
+
+def _connection():
+    # Connections cannot be shared between threads and processes.
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.cnn = sqlite3.connect(const.CONTENT_PATH, timeout=60)
+    return _local.cnn
+
+
+def digest(content):
+    return hashlib.sha1(content.encode('utf-8')).digest()
+
+
+def _store(cnn, items):
+    items = [(item_id, digest(content), content) for item_id, content in items]
+    query = 'INSERT OR IGNORE INTO bodies(hash, data) VALUES(?, ?)'
+    cnn.executemany(query, ((h, content) for i, h, content in items))
+    # Triggers will take care of reference counts
+    query = 'UPDATE item_bodies SET hash=? WHERE id=? AND hash IS NOT ?'
+    cnn.executemany(query, ((h, i, h) for i, h, content in items))
+    query = 'INSERT OR IGNORE INTO item_bodies(id, hash) VALUES(?, ?)'
+    cnn.executemany(query, ((i, h) for i, h, content in items))
+
+
+def store(items):
+    """ Synchronously stores (id, content) pairs in a single transaction. For
+    use in parsing workers """
+    cnn = _connection()
+    with cnn:
+        _store(cnn, items)
+
+
+def deduplicate(cnn):
+    """ Moves contents into content-addressed bodies """
+    script('content', '02-bodies.sql')(cnn)
+    query = 'SELECT id, data FROM content WHERE id NOT IN (SELECT id FROM ' \
+            'item_bodies)'
+    # Contents might not fit into memory all at once
+    cursor = cnn.execute(query)
+    rows = cursor.fetchmany(500)
+    while rows:
+        _store(cnn, rows)
+        rows = cursor.fetchmany(500)
+    cnn.execute('DROP TABLE content')
+
+
+migrations = [script('content', '01-initial.sql'),
+              import_files,
+              deduplicate,
+              incremental_vacuum]
+
+# Started in views.application.Application.on_startup
+contents = SQLite(const.CONTENT_PATH, migrations=migrations, readers=1)
@@ -1,8 +1,10 @@
+import random
 import sqlite3
+from gi.repository import GLib
 from gi.repository import Soup
 from gi.repository import Gtk
 
-from trifle.utils.common import get_data_path
+from trifle.utils.common import get_data_path, logger
 from trifle.utils.const import VERSION
 
 class Message(Soup.Message):
@@ -25,6 +27,111 @@ class AuthMessage(Message):
         return obj
 
 
+class ErrorBudget(object):
+    """
+    Limits amount of retries done during a synchronization, so unavailable
+    server doesn't get hammered, and keeps account of failed requests.
+    """
+    def __init__(self, retries=32):
+        self.retries = retries
+        self.requests = self.retried = self.failed = 0
+
+    def spend(self):
+        """ Returns whether there's a retry left and takes it """
+        if self.retried >= self.retries:
+            if self.retried == self.retries:
+                logger.warning('Error budget exhausted, giving up retrying')
+                self.retried += 1
+            return False
+        self.retried += 1
+        return True
+
+    def __str__(self):
+        return '{0} requests, {1} retries, {2} failed'.format(
+               self.requests, min(self.retried, self.retries), self.failed)
+
+
+class RetryPolicy(object):
+    """
+    Decides whether failed request should be sent again and when. Delays
+    grow exponentially and are randomized (full jitter), so requests failed
+    together are not retried together.
+    """
+    # Statuses, which could be different if we asked again a bit later
+    retry_statuses = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, attempts=4, base=1.0, cap=60.0, budget=None):
+        self.attempts, self.base, self.cap = attempts, base, cap
+        self.budget = ErrorBudget() if budget is None else budget
+
+    def should_retry(self, msg, attempt):
+        status = msg.status_code
+        if status == Soup.Status.CANCELLED:
+            return False
+        # Transport errors (no connection, timeouts, etc.) are below 100
+        transient = status < 100 or status in self.retry_statuses
+        return transient and attempt + 1 < self.attempts and \
+               self.budget.spend()
+
+    def delay(self, msg, attempt):
+        """ Seconds to wait before sending attempt + 1 """
+        headers = msg.get_property('response-headers')
+        retry_after = headers.get_one('Retry-After') if headers else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(self.cap, int(retry_after))
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class Session(Soup.SessionAsync):
+    def __init__(self, *args, **kwargs):
+        super(Session, self).__init__(*args, **kwargs)
+        # Messages waiting to be sent again and how to give up on them
+        self.retrying = {}
+
+    def queue_message(self, msg, callback, data=None, retry=None):
+        """ If RetryPolicy is given as retry, callback will be called only
+        with the last attempt's response """
+        if retry is None:
+            return super(Session, self).queue_message(msg, callback, data)
+
+        def on_response(session, msg, attempt):
+            if retry.should_retry(msg, attempt):
+                delay = retry.delay(msg, attempt)
+                logger.warning('Request to {0} failed with {1}, retrying in '
+                               '{2:.1f}s'.format(msg.get_uri().to_string(False),
+                                                 msg.status_code, delay))
+                source = GLib.timeout_add(int(delay * 1000), send, attempt + 1)
+                self.retrying[msg] = source, lambda: on_response(self, msg,
+                                                                 attempt)
+                return
+            # Cancelled requests have not failed
+            if not 200 <= msg.status_code < 400 and \
+               msg.status_code != Soup.Status.CANCELLED:
+                retry.budget.failed += 1
+            callback(session, msg, data)
+
+        def send(attempt):
+            self.retrying.pop(msg, None)
+            # Finished message may be queued again, its response is
+            # cleared when it's being sent.
+            super(Session, self).queue_message(msg, on_response, attempt)
+            return False
+
+        retry.budget.requests += 1
+        send(0)
+
+    def cancel(self, msg):
+        """ Cancels message, which is either being sent or waits to be sent
+        again. Its callback is called with CANCELLED status """
+        if msg not in self.retrying:
+            self.cancel_message(msg, Soup.Status.CANCELLED)
+            return
+        source, give_up = self.retrying.pop(msg)
+        GLib.source_remove(source)
+        msg.set_status(Soup.Status.CANCELLED)
+        give_up()
+
+
 class TreeModelFilter(Gtk.TreeModelFilter):
     def set_value(self, iter, column, val):
         # Delegate change to parent
@@ -1,76 +1,367 @@
 from gi.repository import GLib, GObject
 import os
 import sqlite3
+import itertools
 import logging
 import threading
+import time
 import queue
+from collections import deque
+from urllib.request import pathname2url
 
 logger = logging.getLogger('trifle')
 
 from trifle.utils import const, async, get_data_path
 
 
+class Statistics(object):
+    """
+    Per-statement timings of jobs executed by SQLite and SQLiteReader
+    threads. Statements are identified by their text with whitespace
+    normalized.
+    """
+    # Amount of latest execution times kept for percentile calculation
+    samples = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statements = {}
+        self.plans = {}
+
+    @staticmethod
+    def normalize(sql):
+        return ' '.join(sql.split())
+
+    def record(self, sql, waited, took, rows):
+        with self._lock:
+            if sql not in self._statements:
+                self._statements[sql] = {'calls': 0, 'total': 0, 'rows': 0,
+                                         'wait': 0,
+                                         'times': deque(maxlen=self.samples)}
+            stat = self._statements[sql]
+            stat['calls'] += 1
+            stat['total'] += took
+            stat['rows'] += rows
+            stat['wait'] += waited
+            stat['times'].append(took)
+
+    def explain(self, cnn, method, args):
+        """ Logs query plan of a statement the first time it is executed """
+        sql = self.normalize(args[0])
+        if sql in self.plans or not sql.upper().startswith(('SELECT',
+           'INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+            return args
+        params = args[1] if len(args) > 1 else ()
+        if method == 'executemany':
+            # Parameters might be a generator, we must not lose its first item
+            params = iter(params)
+            first = next(params, None)
+            args = (args[0], itertools.chain((first,), params))
+            params = first if first is not None else ()
+        try:
+            plan = cnn.execute('EXPLAIN QUERY PLAN ' + args[0], params)
+            self.plans[sql] = [row[-1] for row in plan.fetchall()]
+        except sqlite3.Error:
+            self.plans[sql] = []
+        logger.debug('Query plan of {0}: {1}'.format(sql, self.plans[sql]))
+        return args
+
+    def report(self):
+        """ Formats collected statistics, slowest statements first """
+        def percentile(times, pct):
+            return times[min(len(times) - 1, int(len(times) * pct))]
+
+        with self._lock:
+            stats = sorted(self._statements.items(), reverse=True,
+                           key=lambda item: item[1]['total'])
+            lines = ['{0:>7} {1:>9} {2:>8} {3:>8} {4:>9} {5:>9}  {6}'.format(
+                     'calls', 'total ms', 'p50 ms', 'p99 ms', 'rows',
+                     'wait ms', 'statement')]
+            for sql, stat in stats:
+                times = sorted(stat['times'])
+                lines.append('{0:>7} {1:>9.1f} {2:>8.2f} {3:>8.2f} {4:>9} '
+                             '{5:>9.1f}  {6}'.format(stat['calls'],
+                             stat['total'] * 1E3,
+                             percentile(times, 0.5) * 1E3,
+                             percentile(times, 0.99) * 1E3, stat['rows'],
+                             stat['wait'] * 1E3, sql))
+                for step in self.plans.get(sql, ()):
+                    lines.append(' ' * 59 + '-- ' + step)
+        return '\n'.join(lines)
+
+
+def _execute(cnn, stats, job, method, args, kwargs, queued):
+    start = time.monotonic()
+    rows = 0
+    try:
+        explain = method in ('execute', 'executemany', 'iterate')
+        if explain and logger.isEnabledFor(logging.DEBUG):
+            args = stats.explain(cnn, method, args)
+        if method == 'call':
+            job.result = args[0](cnn, *args[1:], **kwargs)
+        elif method == 'iterate':
+            cursor = cnn.execute(*args)
+            page = cursor.fetchmany(kwargs['page_size'])
+            while page:
+                rows += len(page)
+                job.add_rows(page)
+                page = cursor.fetchmany(kwargs['page_size'])
+        else:
+            result = getattr(cnn, method)(*args, **kwargs)
+            if hasattr(result, 'fetchall'):
+                job.result = result.fetchall()
+                rows = len(job.result)
+            else:
+                job.result = result
+        GLib.idle_add(job.emit, 'finished', True)
+    except: # Yes, catch 'em all!
+        logger.exception('SQLite error')
+        GLib.idle_add(job.emit, 'finished', False)
+    finally:
+        if method == 'call':
+            sql = '{0}()'.format(args[0].__name__)
+        else:
+            sql = stats.normalize(args[0]) if args else method.upper()
+        stats.record(sql, start - queued, time.monotonic() - start, rows)
+
+
+class SQLiteReader(threading.Thread):
+    """
+    Executes read-only queries on a separate connection. Thanks to WAL
+    journal these do not need to wait for writes queued in SQLite thread.
+    """
+    def __init__(self, database, jobs, ready, statistics):
+        super(SQLiteReader, self).__init__()
+        self.daemon = True
+        self._database, self._jobs, self._ready = database, jobs, ready
+        self.statistics = statistics
+
+    def run(self):
+        # Writer is responsible for creating database and enabling WAL
+        self._ready.wait()
+        uri = 'file:{0}?mode=ro'.format(pathname2url(self._database))
+        with sqlite3.connect(uri, uri=True) as cnn:
+            while True:
+                job, method, args, kwargs, queued = self._jobs.get()
+                if method is None:
+                    self._jobs.task_done()
+                    break
+                _execute(cnn, self.statistics, job, method, args, kwargs,
+                         queued)
+                self._jobs.task_done()
+
+
 class SQLite(threading.Thread):
-    def __init__(self, *args, **kwargs):
+    """
+    The only thread writing to the database. Jobs which only read data and
+    do not need to see uncommited changes should go to `select`, they are
+    served by a pool of SQLiteReader threads in parallel with writes.
+    """
+    def __init__(self, *args, batch_size=512, batch_latency=0.05, readers=2,
+                 migrations=(), **kwargs):
         super(SQLite, self).__init__()
         self.daemon = True
-        # Contains jobs in form of (SQLiteJob, callable, args, kwargs)
+        self.migrations = migrations
+        self.statistics = Statistics()
+        # Contains jobs in form of (SQLiteJob, method, args, kwargs, time when
+        # job was queued)
         self._jobs = queue.Queue()
         self._args, self._kwargs = args, kwargs
+        # Same as _jobs, but for SQLiteReader threads
+        self._reads = queue.Queue()
+        self._ready = threading.Event()
+        self._readers = [SQLiteReader(args[0], self._reads, self._ready,
+                                      self.statistics)
+                         for _ in range(readers)]
+        # All jobs waiting in the queue are executed in a single transaction,
+        # which is commited once. These limit how many jobs such transaction
+        # may contain and for how long (in seconds) we wait for more jobs to
+        # arrive before commiting.
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
 
     def run(self):
         with sqlite3.Connection(*self._args, **self._kwargs) as cnn:
             del self._args, self._kwargs
-            while True:
-                job, method, args, kwargs = self._jobs.get()
-                if method is None:
-                    break
-                try:
-                    result = getattr(cnn, method)(*args, **kwargs)
-                    if hasattr(result, 'fetchall'):
-                        job.result = result.fetchall()
+            # Lets us give pages of deleted rows back to the filesystem with
+            # PRAGMA incremental_vacuum. Has effect only on new databases and
+            # must precede enabling WAL, which creates the database file.
+            cnn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # Lets readers and the writer work concurrently
+            cnn.execute('PRAGMA journal_mode=WAL')
+            try:
+                self._migrate(cnn)
+            finally:
+                self._ready.set()
+            running = True
+            while running:
+                batch = self._next_batch()
+                # Commit requests are postponed until whole batch is executed
+                commits = []
+                for job, method, args, kwargs, queued in batch:
+                    if method is None:
+                        running = False
+                    elif method == 'commit':
+                        commits.append((job, queued))
                     else:
-                        job.result = result
-                    GLib.idle_add(job.emit, 'finished', True)
-                except: # Yes, catch 'em all!
-                    logger.exception('SQLite error')
-                    GLib.idle_add(job.emit, 'finished', False)
-                self._jobs.task_done()
+                        _execute(cnn, self.statistics, job, method, args,
+                                 kwargs, queued)
+                self._commit(cnn, commits)
+                for _ in batch:
+                    self._jobs.task_done()
         GLib.idle_add(self.join)
 
-    def commit(self, *args, **kwargs):
-        job = async.Job()
-        self._jobs.put((job, 'commit', args, kwargs))
+    def _migrate(self, cnn):
+        """ Brings database schema up to date. Schema version is kept in
+        user_version pragma and is equal to the amount of migrations applied.
+
+        If a migration fails, the rest of them are not applied and jobs are
+        served with the schema we have, failed migration is retried on the
+        next start.
+        """
+        current = cnn.execute('PRAGMA user_version').fetchone()[0]
+        pending = self.migrations[current:]
+        for version, migration in enumerate(pending, current + 1):
+            logger.debug('Migrating database to version {0}'.format(version))
+            try:
+                migration(cnn)
+                cnn.execute('PRAGMA user_version={0:d}'.format(version))
+                cnn.commit()
+            except Exception:
+                logger.exception('Migration of database to version {0} '
+                                 'failed'.format(version))
+                cnn.rollback()
+                return
+
+    def _next_batch(self):
+        """ Blocks until there's at least one job and then collects all other
+        jobs which are already waiting or arrive in batch_latency seconds """
+        batch = [self._jobs.get()]
+        deadline = time.monotonic() + self.batch_latency
+        while len(batch) < self.batch_size and batch[-1][1] is not None:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._jobs.get(timeout=timeout))
+                else:
+                    batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, cnn, jobs):
+        success, start = True, time.monotonic()
+        if cnn.in_transaction:
+            try:
+                cnn.commit()
+            except:
+                logger.exception('SQLite commit failed')
+                success = False
+            took = time.monotonic() - start
+            waited = max([start - queued for job, queued in jobs] or [0])
+            self.statistics.record('COMMIT', waited, took, 0)
+        for job, queued in jobs:
+            GLib.idle_add(job.emit, 'finished', success)
+
+    def start(self):
+        super(SQLite, self).start()
+        for reader in self._readers:
+            reader.start()
+
+    def _queue(self, jobs, method, args, kwargs):
+        job = async.PagedJob() if method == 'iterate' else async.Job()
+        jobs.put((job, method, args, kwargs, time.monotonic()))
         return job
 
+    def commit(self, *args, **kwargs):
+        return self._queue(self._jobs, 'commit', args, kwargs)
+
     def execute(self, *args, **kwargs):
-        job = async.Job()
-        self._jobs.put((job, 'execute', args, kwargs))
-        return job
+        return self._queue(self._jobs, 'execute', args, kwargs)
 
     def executemany(self, *args, **kwargs):
-        job = async.Job()
-        self._jobs.put((job, 'executemany', args, kwargs))
-        return job
+        return self._queue(self._jobs, 'executemany', args, kwargs)
 
     def executescript(self, *args, **kwargs):
-        job = async.Job()
-        self._jobs.put((job, 'executescript', args, kwargs))
-        return job
+        return self._queue(self._jobs, 'executescript', args, kwargs)
+
+    def call(self, *args, **kwargs):
+        """ Calls fn(connection, *args, **kwargs) in SQLite thread, result of
+        the call becomes result of the job. For work which needs to inspect
+        results of one query before executing the next one. """
+        return self._queue(self._jobs, 'call', args, kwargs)
+
+    def select(self, *args, page_size=None, **kwargs):
+        """ Same as execute, but query is executed by one of readers, thus
+        it will not see changes which are not commited yet.
+
+        If page_size is given, result is not collected into `result`, but
+        delivered in lists of up to page_size rows via 'rows' signal of the
+        returned job instead.
+        """
+        if page_size is not None:
+            kwargs['page_size'] = page_size
+            return self._queue(self._reads, 'iterate', args, kwargs)
+        return self._queue(self._reads, 'execute', args, kwargs)
 
     def stop(self, *args, **kwargs):
-        self._jobs.put((None, None, None, None,))
+        self._jobs.put((None, None, None, None, None,))
+        for reader in self._readers:
+            self._reads.put((None, None, None, None, None,))
+
+
+def vacuum(cnn):
+    """ Gives free pages back to the filesystem, returns amount of bytes
+    freed. Meant to be used with SQLite.call """
+    page_size = cnn.execute('PRAGMA page_size').fetchone()[0]
+    free = cnn.execute('PRAGMA freelist_count').fetchone()[0]
+    # execute would run only a single step of vacuum, freeing only one page
+    cnn.executescript('PRAGMA incremental_vacuum')
+    return (free - cnn.execute('PRAGMA freelist_count').fetchone()[0]) * \
+           page_size
+
+
+def script(*path):
+    """ Creates a migration, which executes SQL script from data/migrations.
+    Scripts should be safe to execute on partially migrated database """
+    def migration(cnn):
+        with open(get_data_path('migrations', *path), 'r') as script:
+            cnn.executescript(script.read())
+    return migration
 
 
+def incremental_vacuum(cnn):
+    """ Migration enabling incremental vacuum on databases created before
+    it was enabled on new ones. The setting takes effect only after VACUUM,
+    which rewrites the whole database once """
+    if cnn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        cnn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cnn.execute('VACUUM')
+
+
+def add_column(table, column, definition):
+    """ Creates a migration, which adds a column unless it exists already """
+    def migration(cnn):
+        columns = cnn.execute('PRAGMA table_info({0})'.format(table))
+        if column not in (row[1] for row in columns.fetchall()):
+            cnn.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                        table, column, definition))
+    return migration
+
+# Position of migration in the list is the schema version it upgrades
+# database to. Only append to this list, never reorder or remove migrations.
+migrations = [script('metadata', '01-initial.sql'),
+              script('metadata', '02-indexes.sql'),
+              script('metadata', '03-search.sql'),
+              script('metadata', '04-sync-state.sql'),
+              # Hash of content as received from server
+              add_column('items', 'content_hash', 'BLOB'),
+              script('metadata', '06-changes.sql'),
+              incremental_vacuum]
+
 _sqlite_path = os.path.join(const.CACHE_PATH, 'metadata')
-_init_sqlite = not os.path.exists(_sqlite_path)
-if _init_sqlite and not os.path.exists(os.path.dirname(_sqlite_path)):
+if not os.path.exists(os.path.dirname(_sqlite_path)):
     os.makedirs(os.path.dirname(_sqlite_path))
 
 # Started in views.application.Application.on_startup
-sqlite = SQLite(_sqlite_path)
-
-if _init_sqlite:
-    with open(get_data_path('db_init.sql'), 'r') as script:
-        sqlite.executescript(script.read())
-        sqlite.commit()
+sqlite = SQLite(_sqlite_path, migrations=migrations)
@@ -3,9 +3,13 @@ from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
+import sys
 
 from trifle import models, views
-from trifle.utils import logger, get_data_path, connect_once, sqlite
+from trifle.arguments import arguments
+from trifle.utils import (logger, get_data_path, connect_once, sqlite,
+                          contents, RetryPolicy)
+from trifle.utils.async import WorkerPool, benchmark
 
 
 def ensure_login(func):
@@ -20,9 +24,15 @@ def ensure_login(func):
 
 class Application(Gtk.Application):
     last_sync = GObject.property(type=object)
+    sync_coordinator = GObject.property(type=models.scheduler.SyncCoordinator)
+    parse_pool = GObject.property(type=object)
     _login_view = None
     _items_model = None
     _subscr_model = None
+    # Parse workers write contents directly, so synchronization waits for
+    # migrations of contents database. Request which arrived meanwhile.
+    _contents_migrated = False
+    _pending_sync = None
 
     @GObject.property(type=views.windows.LoginDialog)
     def login_view(self):
@@ -30,10 +40,13 @@ class Application(Gtk.Application):
             self._login_view = views.windows.LoginDialog(modal=True)
         return self._login_view
 
-    @GObject.property(type=models.feeds.Store)
+    @GObject.property(type=GObject.Object)
     def items_model(self):
         if self._items_model is None:
-            self._items_model = models.feeds.Store()
+            if models.settings.settings['items-model'] == 'paged':
+                self._items_model = models.feeds.PagedStore()
+            else:
+                self._items_model = models.feeds.Store()
             self._items_model.update()
         return self._items_model
 
@@ -41,6 +54,7 @@ class Application(Gtk.Application):
     def subscr_model(self):
         if self._subscr_model is None:
             self._subscr_model = models.subscriptions.Subscriptions()
+            self._subscr_model.count_items(self.items_model.members)
             self._subscr_model.update()
         return self._subscr_model
 
@@ -55,8 +69,16 @@ class Application(Gtk.Application):
 
     @staticmethod
     def on_startup(self):
-        # Start the sqlite driver
+        # Start the sqlite drivers
         sqlite.start()
+        contents.start()
+        # Jobs are executed after migrations
+        contents.commit().connect('finished', self.on_contents_migrated)
+        # Items are parsed by these workers
+        self.parse_pool = WorkerPool(models.itemparse.warm)
+        self.choose_parse_engine()
+        models.settings.settings.connect('changed::parse-engine',
+                                         lambda *x: self.choose_parse_engine())
 
         # Initialize application menu
         actions = [('synchronize', self.on_sync),
@@ -73,6 +95,8 @@ class Application(Gtk.Application):
         self.set_app_menu(builder.get_object('app-menu'))
 
         # Check for need to refresh every 60 seconds.
+        coordinator = models.scheduler.SyncCoordinator(self.build_sync)
+        self.sync_coordinator = coordinator
         GLib.timeout_add_seconds(60, self.on_sync_timeout)
         self.last_sync = GLib.get_monotonic_time()
         if models.settings.settings['start-refresh']:
@@ -94,10 +118,49 @@ class Application(Gtk.Application):
 
     @staticmethod
     def on_shutdown(self):
-        sqlite._jobs.join()
+        self.sync_coordinator.cancel()
+        self.parse_pool.shutdown()
+        for database in (sqlite, contents):
+            database._jobs.join()
+            database.commit()
+            database.stop()
+            database.join()
+        if arguments.sql_stats:
+            print(sqlite.statistics.report(), file=sys.stderr)
+
+    def choose_parse_engine(self):
+        engine = models.settings.settings['parse-engine']
+        if engine != 'auto':
+            self.set_parse_engine(engine)
+            return
+        # Benchmark is done only once, its result is remembered
+        query = 'SELECT value FROM sync_state WHERE key=\'parse-engine\''
+        sqlite.select(query).connect('finished', self.on_parse_engine)
+
+    def on_parse_engine(self, job, success):
+        if success and job.result:
+            self.set_parse_engine(job.result[0][0])
+            return
+        logger.debug('Benchmarking parse engines')
+        itemparse = models.itemparse
+        benchmark(itemparse.parse_items, (itemparse.sample(),),
+                  self.on_parse_benchmark, initializer=itemparse.warm)
+
+    def on_parse_benchmark(self, results):
+        engine = min(results, key=results.get)
+        logger.debug('Parse engine benchmark: {0}, using {1}'.format(
+                     ', '.join('{0} {1:.2f}s'.format(*r)
+                               for r in results.items()), engine))
+        query = '''INSERT OR REPLACE INTO sync_state(key, value)
+                   VALUES ('parse-engine', ?)'''
+        sqlite.execute(query, (engine,))
         sqlite.commit()
-        sqlite.stop()
-        sqlite.join()
+        self.set_parse_engine(engine)
+
+    def set_parse_engine(self, engine):
+        self.parse_pool.engine = engine
+        # Start a worker now so the next synchronization doesn't wait for it
+        self.parse_pool.warm()
 
     def on_show_prefs(self, action, data=None):
         props = {'modal': True, 'transient-for': self.get_active_window()}
@@ -115,50 +178,70 @@ class Application(Gtk.Application):
                  'login_view': self.login_view}
         dialog = views.windows.SubscribeDialog(**props)
         dialog.show_all()
-        dialog.connect('subscribed', lambda *a: self.on_sync(None))
+        # Running synchronization might have fetched subscriptions already
+        dialog.connect('subscribed', lambda *a: self.on_sync(None, True))
 
     @ensure_login
-    def on_sync(self, action, data=None):
-        def on_sync_done(synchronizer, data=None):
-            self.last_sync = GLib.get_monotonic_time()
+    def on_sync(self, action, follow_up=None):
+        """ Synchronizes unless synchronization is running already.
+        follow_up should be true if the running synchronization isn't good
+        enough, because request needs data not yet present on the server when
+        it started. Manual refresh (action is given) is such a request. """
+        follow_up = bool(follow_up or action is not None)
+        if not self._contents_migrated:
+            self._pending_sync = self._pending_sync or follow_up
+            return
+        self.sync_coordinator.request(follow_up)
 
-        def on_subscr_sync_done(synchronizer, data=None):
-            self.subscr_model.update()
+    def on_contents_migrated(self, job, success):
+        self._contents_migrated = True
+        if self._pending_sync is not None:
+            self.sync_coordinator.request(self._pending_sync)
+            self._pending_sync = None
 
-        def on_items_sync_done(synchronizer, data=None):
-            self.items_model.update()
-            connect_once(self.items_model, 'updated', notify)
+    def build_sync(self):
+        def on_stage_done(scheduler, stage, success):
+            # Either of items and favicons synchronized counts as a
+            # synchronization, so a single failing stage doesn't cause a
+            # resync every minute
+            if success and stage in ('items', 'favicons'):
+                self.last_sync = GLib.get_monotonic_time()
+            # Models reflect whatever got into the database, even if some
+            # of the stages failed
+            if stage == 'items':
+                self.items_model.update()
+                connect_once(self.items_model, 'updated', notify)
+            elif stage == 'garbage':
+                # Runs along with items and deletes rows of expired ones
+                self.items_model.update()
+            elif stage == 'favicons':
+                self.subscr_model.update()
 
         def notify(model, data=None):
             notification = views.notifications.notification
             notification.notify_unread_count(model.unread_count())
 
-        def on_flags_sync_done(synchronizer, data=None):
-            def cb(*args):
-                ids.sync()
-                return False
-            # Delay next stage so servers can clean up their caches.
-            # Still doesn't always work...
-            GLib.timeout_add_seconds(1, cb)
-
         logger.debug('Starting synchronization')
-        auth = self.login_view.model
-        # Items synchronization
-        ids = models.synchronizers.Id(auth=auth)
-        flags = models.synchronizers.Flags(auth=auth)
-        items = models.synchronizers.Items(auth=auth)
-        connect_once(flags, 'sync-done', on_flags_sync_done)
-        connect_once(ids, 'sync-done', lambda *x: items.sync())
-        connect_once(items, 'sync-done', on_sync_done)
-        connect_once(items, 'sync-done', on_items_sync_done)
-        flags.sync()
+        # All the requests of a synchronization share one error budget
+        props = {'auth': self.login_view.model, 'retry': RetryPolicy()}
+        synchronizers = models.synchronizers
+        scheduler = models.scheduler.Scheduler()
+        # Items synchronization. Local flag changes must reach the server
+        # before we ask it for states of items.
+        scheduler.add('flags', synchronizers.Flags(**props))
+        scheduler.add('ids', synchronizers.Id(**props), after=('flags',))
+        scheduler.add('garbage', synchronizers.Garbage(**props),
+                      after=('ids',))
+        scheduler.add('items', synchronizers.Items(executor=self.parse_pool,
+                                                   **props), after=('ids',))
         # Subscriptions synchronization
-        subscriptions = models.synchronizers.Subscriptions(auth=auth)
-        icons = models.synchronizers.Favicons(auth=auth)
-        connect_once(subscriptions, 'sync-done', lambda *x: icons.sync())
-        connect_once(icons, 'sync-done', on_sync_done)
-        connect_once(icons, 'sync-done', on_subscr_sync_done)
-        subscriptions.sync()
+        scheduler.add('subscriptions', synchronizers.Subscriptions(**props))
+        scheduler.add('favicons', synchronizers.Favicons(**props),
+                      after=('subscriptions',))
+        scheduler.connect('stage-done', on_stage_done)
+        scheduler.connect('finished', lambda *x: logger.debug(
+            'Synchronization requests: {0}'.format(props['retry'].budget)))
+        return scheduler
 
     def on_sync_timeout(self):
         current = GLib.get_monotonic_time()
@@ -2,18 +2,16 @@
 from gettext import gettext as _
 from gi.repository import Gdk
 from gi.repository import Gio
-from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Pango
 from gi.repository import WebKit
 import base64
 import datetime
-import os
 
 from trifle.arguments import arguments
 from trifle.utils import (get_data_path, logger, parse_font, ItemsColumn,
-                          TreeModelFilter, split_id, CONTENT_PATH,
+                          TreeModelFilter, split_id, contents,
                           SubscriptionColumn)
 from trifle import models
 
@@ -70,7 +68,7 @@ class ItemView(WebKit.WebView):
     item_id = GObject.property(type=object)
     font = GObject.property(type=GObject.TYPE_STRING)
     monospace = GObject.property(type=GObject.TYPE_STRING)
-    load_cancellable = GObject.property(type=Gio.Cancellable)
+    content_job = GObject.property(type=object)
 
     def __init__(self, *args, **kwargs):
         # TODO: Change to DOCUMENT_VIEWER after we start caching remote
@@ -150,23 +148,19 @@ class ItemView(WebKit.WebView):
                                            monospace_font_family=family)
 
     def on_item_change(self, *args):
-        if self.load_cancellable is not None:
-            self.load_cancellable.cancel()
-        self.load_cancellable = Gio.Cancellable()
-
-        fpath = os.path.join(CONTENT_PATH, str(self.item_id))
-        f = Gio.File.new_for_path(fpath)
-        f.load_contents_async(self.load_cancellable, self.on_content_loaded,
-                              None)
-
-    def on_content_loaded(self, f, result, data):
-        try:
-            content = f.load_contents_finish(result)[1].decode('utf-8')
-        except GLib.GError as e:
-            if e.code == GLib.FileError.AGAIN: # Cancelled
-                return
-            else:
-                raise
+        query = '''SELECT data FROM item_bodies JOIN bodies USING(hash)
+                   WHERE id=?'''
+        self.content_job = contents.select(query, (self.item_id,))
+        self.content_job.connect('finished', self.on_content_loaded)
+
+    def on_content_loaded(self, job, success):
+        if job is not self.content_job:
+            return # Another item was selected in the meantime
+        if not success or len(job.result) == 0:
+            logger.error('No content for item {0}'.format(self.item_id))
+            content = ''
+        else:
+            content = job.result[0][0]
 
         # Scroll to (0, 0)
         self.get_hadjustment().set_value(0)
@@ -241,8 +235,17 @@ class SubscriptionsView(Gtk.TreeView):
         column.pack_start(title_renderer, True)
         column.add_attribute(title_renderer, 'text', SubscriptionColumn.NAME)
 
+        count_renderer = Gtk.CellRendererText(xalign=1.0)
+        column.pack_start(count_renderer, False)
+        column.set_cell_data_func(count_renderer, self.render_unread)
+
         self.append_column(column)
 
+    @staticmethod
+    def render_unread(column, renderer, model, itr, data=None):
+        unread = model[itr][SubscriptionColumn.UNREAD]
+        renderer.set_property('text', str(unread) if unread else '')
+
 #         self.connect('popup-menu', SubscriptionsView.on_popup_menu)
 #         self.connect('button-press-event', SubscriptionsView.on_button_press)
 
@@ -295,8 +298,7 @@ class ItemsView(Gtk.TreeView):
     subscription = GObject.property(type=GObject.TYPE_STRING)
     is_label = GObject.property(type=GObject.TYPE_BOOLEAN, default=False)
 
-    main_model = GObject.property(type=models.feeds.Store, default=None)
-    category_model = GObject.property(type=GObject.Object, default=None)
+    main_model = GObject.property(type=GObject.Object, default=None)
 
     def __init__(self, *args, **kwargs):
         super(ItemsView, self).__init__(*args, **kwargs)
@@ -316,48 +318,27 @@ class ItemsView(Gtk.TreeView):
         self.connect('notify::subscription', self.subscription_change)
 
     def category_change(self, w, gprop):
-        # Still not initialized fully.
-        if not self.main_model:
-            return
+        # Changing a category clears subscription filter.
+        self.show_items(None, False)
 
-        if self.category in ('unread', 'starred'):
-            if self.category == 'unread':
-                cat_col = ItemsColumn.UNREAD
-            else:
-                cat_col = ItemsColumn.STARRED
-            visible_col = ItemsColumn.FORCE_VISIBLE
-            visible_func = lambda m, i, d: m[i][cat_col] or m[i][visible_col]
-            filt = TreeModelFilter(child_model=self.main_model)
-            filt.set_visible_func(visible_func)
-            self.set_model(filt)
-            self.category_model = filt
+    def subscription_change(self, w, gprop):
+        if self.is_label:
+            self.show_items(self.subscription, True)
         else:
-            self.set_model(self.main_model)
-            self.category_model = self.main_model
+            self.show_items(split_id(self.subscription)[1], False)
 
-        # Should be at the end of the function
-        # Or rather there should be no selection when this is called.
-        self.main_model.unforce_all()
-
-    def subscription_change(self, w, gprop):
+    def show_items(self, feed, is_label):
         # Still not initialized fully.
         if not self.main_model:
             return
-
-        if self.is_label:
-            key, subscr = ItemsColumn.LBL_ID, self.subscription
-        else:
-            key = ItemsColumn.SUB_ID
-            subscr = split_id(self.subscription)[1]
-
-        visible_func = lambda m, i, d: m[i][d[0]] == d[1]
-        filt = TreeModelFilter(child_model=self.category_model)
-        filt.set_visible_func(visible_func, (key, subscr))
-        self.set_model(filt)
-
-        # Should be at the end of the function
-        # Or rather there should be no selection when this is called.
+        # Model knows which rows are visible. Without a filter listening to
+        # it, rows changing visibility are not refiltered one by one.
+        self.set_model(None)
         self.main_model.unforce_all()
+        self.main_model.show(self.category, feed, is_label)
+        filt = TreeModelFilter(child_model=self.main_model)
+        filt.set_visible_column(ItemsColumn.VISIBLE)
+        self.set_model(filt)
 
 
 GObject.type_register(MainToolbar)
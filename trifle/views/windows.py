@@ -62,13 +62,14 @@ class ApplicationWindow(BuiltMixin, Gtk.ApplicationWindow):
         item_view = self._builder.get_object('item-view')
         items = self._builder.get_object('items-view')
         item_id = item_view.item_id
-        for row in items.main_model:
-            if row[ItemsColumn.ID] == item_id:
-                row[ItemsColumn.FORCE_VISIBLE] = True
-                row[column] = value
-                return
-        logger.error("Couldn't set status for item {0}, it doesn't exist"
+        itr = items.main_model.iter_of(item_id)
+        if itr is None:
+            logger.error("Couldn't set status for item {0}, it doesn't exist"
                                                              .format(item_id))
+            return
+        row = items.main_model[itr]
+        row[ItemsColumn.FORCE_VISIBLE] = True
+        row[column] = value
 
     # TODO: These doesn't work correctly.
     # def on_horiz_pos_change(self, paned, gprop):